@@ -11,11 +11,20 @@ index = {"sysinfo": "00_core.ipynb",
          "meta_from_str": "00_core.ipynb",
          "combine_file_and_tl_lists": "00_core.ipynb",
          "meta_to_df": "00_core.ipynb",
+         "build_ann_index": "00_core.ipynb",
+         "ann_index_to_df": "00_core.ipynb",
+         "split_ann_index": "00_core.ipynb",
          "fix_abangle": "00_core.ipynb",
+         "fix_abangle_batch": "00_core.ipynb",
+         "normalize_ann_df": "00_core.ipynb",
          "draw_ellipse": "00_core.ipynb",
+         "draw_ellipses": "00_core.ipynb",
+         "draw_ellipses_batch": "00_core.ipynb",
          "ellipse_to_bbox": "00_core.ipynb",
+         "ellipse_to_bbox_batch": "00_core.ipynb",
          "ring_float_to_class_int": "00_core.ipynb",
          "crop_to_bbox": "00_core.ipynb",
+         "ann_df_to_crop_bboxes": "00_core.ipynb",
          "is_in_box": "00_core.ipynb",
          "acc_reg": "00_core.ipynb",
          "acc_reg05": "00_core.ipynb",
@@ -23,7 +32,15 @@ index = {"sysinfo": "00_core.ipynb",
          "acc_reg1": "00_core.ipynb",
          "acc_reg15": "00_core.ipynb",
          "acc_reg2": "00_core.ipynb",
-         "kfold_split": "00_core.ipynb"}
+         "kfold_split": "00_core.ipynb",
+         "parallel_imap": "00_core.ipynb",
+         "parallel_map": "00_core.ipynb",
+         "crop_index_cols": "00_core.ipynb",
+         "CropShards": "00_core.ipynb",
+         "CropDataset": "00_core.ipynb",
+         "tiled_segreg_name": "00_core.ipynb",
+         "tile_segreg_volume": "00_core.ipynb",
+         "SegregVolume": "00_core.ipynb"}
 
 modules = ["core.py",
            "scripts.py"]
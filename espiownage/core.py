@@ -1,9 +1,12 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/00_core.ipynb (unless otherwise specified).
 
 __all__ = ['sysinfo', 'mkdir_if_needed', 'get_data', 'get_checkpoint', 'meta_to_img_path', 'meta_to_mask_path',
-           'meta_from_str', 'combine_file_and_tl_lists', 'meta_to_df', 'fix_abangle', 'draw_ellipse', 'ellipse_to_bbox',
-           'ring_float_to_class_int', 'crop_to_bbox', 'is_in_box', 'acc_reg', 'acc_reg05', 'acc_reg07', 'acc_reg1',
-           'acc_reg15', 'acc_reg2', 'kfold_split']
+           'meta_from_str', 'combine_file_and_tl_lists', 'meta_to_df', 'build_ann_index', 'ann_index_to_df',
+           'split_ann_index', 'fix_abangle', 'fix_abangle_batch', 'normalize_ann_df', 'draw_ellipse', 'draw_ellipses',
+           'draw_ellipses_batch', 'ellipse_to_bbox', 'ellipse_to_bbox_batch', 'ring_float_to_class_int', 'crop_to_bbox',
+           'ann_df_to_crop_bboxes', 'is_in_box', 'acc_reg', 'acc_reg05', 'acc_reg07', 'acc_reg1', 'acc_reg15',
+           'acc_reg2', 'kfold_split', 'parallel_imap', 'parallel_map', 'crop_index_cols', 'CropShards', 'CropDataset',
+           'tiled_segreg_name', 'tile_segreg_volume', 'SegregVolume']
 
 # Cell
 import cv2
@@ -11,11 +14,24 @@ from PIL import Image
 import numpy as np
 from pathlib import Path
 import os
+import io
+import glob
+import json
 import pandas as pd
 from fastai.torch_core import flatten_check
 import re
 import math
 import torch
+from functools import partial
+import multiprocessing as mp
+from collections import OrderedDict
+
+# Cell
+try:                       # optional: lets the annotation index be stored as Parquet
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 # Cell
 #slow
@@ -143,16 +159,108 @@ def combine_file_and_tl_lists(file_list, top_loss_list):
 def meta_to_df(
     meta_file,  # csv file of ellipse data for an image
     ):
-    "Reads in an espiownage/SPNet CSV file of ellipse data and returns a Pandas DataFrame"
+    "Reads in an espiownage/SPNet CSV file of ellipse data and returns a (normalized) Pandas DataFrame"
     col_names = ['cx', 'cy', 'a', 'b', 'angle', 'rings']
     df = pd.read_csv(meta_file, header=None, names=col_names)
+    return normalize_ann_df(df)
+
+# Cell
+_ann_cols = ['cx', 'cy', 'a', 'b', 'angle', 'rings']
+
+def _read_ann_csv(meta_file):
+    "Raw ellipse rows of one annotation file (duplicates dropped) as an (N,6) float64 array"
+    try:
+        df = pd.read_csv(meta_file, header=None, names=_ann_cols)
+    except pd.errors.EmptyDataError:
+        return np.zeros((0, len(_ann_cols)))
     df.drop_duplicates(inplace=True)  # sometimes the data from Zooniverse has duplicate rows
-    for index, row in df.iterrows() : # fixup stuff
-        [cx, cy, a, b, angle] = [int(round(x)) for x in [row['cx'], row['cy'], row['a'], row['b'], row['angle']]]
-        a, b, angle = fix_abangle(a,b,angle)
-        row['cx'], row['cy'], row['a'], row['b'], row['angle'] = cx, cy, a, b, angle
+    return df.values.astype(np.float64)
+
+def _frame_keys(meta_file):
+    "e.g., annotations/06241902_proc_00510.csv -> ('06241902', 510)"
+    splits = Path(meta_file).stem.split('_')
+    return splits[0], (int(splits[-1]) if splits[-1].isdigit() else -1)
+
+# Cell
+def _save_ann_index(index_file, files, mtimes, sizes, counts, rows):
+    "Writes the annotation index as .npz, or as .parquet (file info goes in the schema metadata)"
+    if str(index_file).endswith('.parquet'):
+        assert pa is not None, "Writing a .parquet annotation index requires pyarrow. Use .npz instead"
+        table = pa.table({c: rows[:,j] for j, c in enumerate(_ann_cols)})
+        info = {'files':list(files), 'mtimes':mtimes.tolist(), 'sizes':sizes.tolist(), 'counts':counts.tolist()}
+        table = table.replace_schema_metadata({'espiownage_files': json.dumps(info)})
+        pq.write_table(table, index_file)
+    else:
+        with open(index_file, 'wb') as f:   # file handle so numpy doesn't tack on another '.npz'
+            np.savez(f, files=np.array(files, dtype=str), mtimes=mtimes, sizes=sizes, counts=counts, rows=rows)
+
+def _load_ann_index(index_file):
+    "Reads what `_save_ann_index` wrote. Returns a dict of arrays"
+    if str(index_file).endswith('.parquet'):
+        assert pa is not None, "Reading a .parquet annotation index requires pyarrow"
+        table = pq.read_table(index_file)
+        info = json.loads(table.schema.metadata[b'espiownage_files'])
+        rows = np.stack([table.column(c).to_numpy() for c in _ann_cols], axis=-1).reshape(-1, len(_ann_cols))
+        return {'files':np.array(info['files'], dtype=str), 'mtimes':np.array(info['mtimes'], dtype=np.float64),
+                'sizes':np.array(info['sizes'], dtype=np.int64), 'counts':np.array(info['counts'], dtype=np.int64), 'rows':rows}
+    with np.load(index_file) as data:
+        return {k: data[k] for k in ['files', 'mtimes', 'sizes', 'counts', 'rows']}
+
+# Cell
+def build_ann_index(
+    files='annotations/*.csv',   # wildcard name for all the annotation CSV files
+    index_file='ann_index.npz',  # where the index lives. Use a .parquet extension for Parquet (needs pyarrow)
+    quiet=False,                 # don't print a summary
+    ):
+    "Creates or refreshes the annotation index, re-parsing only new/changed CSV files. Returns index as a DataFrame"
+    meta_file_list = sorted(glob.glob(files))
+    old = _load_ann_index(index_file) if os.path.exists(index_file) else None
+    if old is not None:
+        old_starts = np.concatenate([[0], np.cumsum(old['counts'])])
+        old_lookup = {f:j for j, f in enumerate(old['files'])}
+    mtimes, sizes, counts, chunks, n_parsed = [], [], [], [], 0
+    for meta_file in meta_file_list:
+        st = os.stat(meta_file)
+        j = None if old is None else old_lookup.get(meta_file, None)
+        if (j is not None) and (old['mtimes'][j] == st.st_mtime) and (old['sizes'][j] == st.st_size):
+            chunk = old['rows'][old_starts[j]:old_starts[j+1]]   # unchanged: reuse what we parsed last time
+        else:
+            chunk, n_parsed = _read_ann_csv(meta_file), n_parsed + 1
+        mtimes.append(st.st_mtime)
+        sizes.append(st.st_size)
+        counts.append(len(chunk))
+        chunks.append(chunk)
+    rows = np.concatenate(chunks) if len(chunks) > 0 else np.zeros((0, len(_ann_cols)))
+    mtimes, sizes, counts = np.array(mtimes, dtype=np.float64), np.array(sizes, dtype=np.int64), np.array(counts, dtype=np.int64)
+    if (old is None) or (n_parsed > 0) or (len(old['files']) != len(meta_file_list)):
+        _save_ann_index(index_file, meta_file_list, mtimes, sizes, counts, rows)
+    if not quiet: print(f"build_ann_index: {len(meta_file_list)} files, {len(rows)} ellipses, {n_parsed} files (re)parsed")
+    return ann_index_to_df(meta_file_list, counts, rows)
+
+# Cell
+def ann_index_to_df(
+    meta_file_list, # list of annotation files in the index
+    counts,         # number of ellipses for each file
+    rows,           # (N,6) array of ellipse data for all files, in order
+    ):
+    "Index arrays -> DataFrame with one row per ellipse, keyed by file, session & frame"
+    keys = [_frame_keys(f) for f in meta_file_list]
+    df = pd.DataFrame(rows, columns=_ann_cols)
+    df.insert(0, 'file', np.repeat(np.array(meta_file_list, dtype=object), counts))
+    df.insert(1, 'session', np.repeat(np.array([k[0] for k in keys], dtype=object), counts))
+    df.insert(2, 'frame', np.repeat(np.array([k[1] for k in keys], dtype=np.int64), counts))
     return df
 
+# Cell
+def split_ann_index(
+    index_df,        # DataFrame from `build_ann_index`
+    meta_file_list,  # which files we want, in order
+    ):
+    "Per-file DataFrames (same columns as reading each CSV) for each file in meta_file_list; empty ones for missing files"
+    groups = {f: g[_ann_cols].reset_index(drop=True) for f, g in index_df.groupby('file', sort=False)}
+    empty = pd.DataFrame(np.zeros((0, len(_ann_cols))), columns=_ann_cols)
+    return [groups.get(f, empty) for f in meta_file_list]
+
 # Cell
 def fix_abangle(
     a:float, # semimajor axis
@@ -166,6 +274,31 @@ def fix_abangle(
     elif angle >= 180: angle -= 180
     return a, b, angle
 
+# Cell
+def fix_abangle_batch(
+    a,     # array of semimajor axes
+    b,     # array of semiminor axes
+    angle, # array of orientation angles in degrees
+    ):
+    "Vectorized version of `fix_abangle`: arrays in, arrays out, same results"
+    a, b, angle = np.asarray(a), np.asarray(b), np.asarray(angle)
+    swap = b > a
+    a, b, angle = np.where(swap, b, a), np.where(swap, a, b), np.where(swap, angle+90, angle)
+    angle = np.where(angle < 0, angle+180, np.where(angle >= 180, angle-180, angle))
+    return a, b, angle
+
+# Cell
+def normalize_ann_df(
+    df,  # DataFrame with columns cx, cy, a, b, angle, rings, e.g. from reading an annotation CSV
+    ):
+    "Rounds ellipse geometry to ints, makes a >= b and 0 <= angle < 180, drops duplicates. Vectorized."
+    cx, cy, a, b, angle = [np.round(df[c].values.astype(np.float64)) for c in _ann_cols[:5]]
+    a, b, angle = fix_abangle_batch(a, b, angle)
+    new_df = pd.DataFrame({'cx':cx, 'cy':cy, 'a':a, 'b':b, 'angle':angle}).astype(np.int16)
+    new_df['rings'] = df['rings'].values.astype(np.float32)
+    new_df.drop_duplicates(inplace=True)  # sometimes the data from Zooniverse has duplicate rows
+    return new_df.reset_index(drop=True)
+
 # Cell
 def draw_ellipse(
     img,         # a cv2 image, *not* a PIL image (similar for grayscale but not RGB)
@@ -189,6 +322,34 @@ def draw_ellipse(
         thickness, lineType, shift)
     return ellipse
 
+# Cell
+def draw_ellipses(
+    img,          # a cv2 image / label mask to draw into (in place)
+    ellipses,     # (N,5) array-like of cx, cy, a, b, angle
+    values,       # (N,) colors / class values, one per ellipse
+    filled=True,  # whether to draw the ellipses as filled or not
+    thickness=2,  # thickness of the lines, if not filled
+    ):
+    "Draws many ellipses into img in order (later ones on top); same pixels as calling `draw_ellipse` for each one"
+    ellipses = np.asarray(ellipses, dtype=np.float64).reshape(-1, 5)
+    centers_axes = np.round(ellipses[:,0:4]).astype(int).tolist()
+    if filled: thickness = -1
+    for (cx, cy, a, b), angle, value in zip(centers_axes, ellipses[:,4].tolist(), np.asarray(values).tolist()):
+        cv2.ellipse(img, (cx, cy), (a, b), -angle, 0, 360, value, thickness, cv2.LINE_8, 0)  # -angle, as in draw_ellipse
+    return img
+
+# Cell
+def draw_ellipses_batch(
+    masks,         # preallocated (B,H,W) uint8 array; gets zeroed, then drawn into
+    ellipse_list,  # list of B (N_i,5) arrays of ellipses, one per mask
+    value_list,    # list of B (N_i,) arrays of class values
+    ):
+    "Fills a batch of label masks with filled ellipses, reusing the same buffer"
+    masks[:] = 0
+    for mask, ellipses, values in zip(masks, ellipse_list, value_list):
+        draw_ellipses(mask, ellipses, values)
+    return masks
+
 # Cell
 def ellipse_to_bbox(
     cx:float, # x-coordinate of center of ellipse
@@ -220,6 +381,33 @@ def ellipse_to_bbox(
         print(f"ellipse_to_bbox: Error: zero-dim bbox = {bbox}. Returning None.")
         return None
 
+# Cell
+def ellipse_to_bbox_batch(
+    cx, cy,     # arrays of x- & y-coordinates of centers of ellipses
+    a, b,       # arrays of semimajor & semiminor axes
+    angle_deg,  # array of orientation angles in degrees
+    coco=False, # COCO style bbox has last 2 nums as width & height of bbox
+    width=512, height=384, # image dimensions for clipping
+    clip=True,  # clip values at max values of image width & height
+    nozero=True,  # mark zero-dimension bounding boxes as invalid
+    verbose=False, # print how many boxes were rejected
+    ):
+    "Vectorized `ellipse_to_bbox`: returns (N,4) array of bboxes and (N,) boolean array of which ones are valid"
+    cx, cy, a, b = [np.asarray(x, dtype=np.float64) for x in [cx, cy, a, b]]  # no int16 overflows please
+    rad = np.radians(np.asarray(angle_deg, dtype=np.float64))
+    a2, b2, cos2, sin2 = [x**2 for x in [a, b, np.cos(rad), np.sin(rad)]]
+    delta_x, delta_y = np.sqrt(a2*cos2 + b2*sin2), np.sqrt(a2*sin2 + b2*cos2)
+    xmin, xmax = np.minimum(cx - delta_x, cx + delta_x), np.maximum(cx - delta_x, cx + delta_x)
+    ymin, ymax = np.minimum(cy - delta_y, cy + delta_y), np.maximum(cy - delta_y, cy + delta_y)
+    if clip:
+        xmin, xmax = np.clip(xmin, 0, width),  np.clip(xmax, 0, width)
+        ymin, ymax = np.clip(ymin, 0, height), np.clip(ymax, 0, height)
+    valid = ((xmax-xmin > 0) & (ymax-ymin > 0)) | (not nozero)
+    if verbose and (~valid).sum() > 0:
+        print(f"ellipse_to_bbox_batch: {(~valid).sum()} of {len(valid)} bboxes have zero dimension")
+    if coco: return np.round(np.stack([xmin, ymin, xmax-xmin, ymax-ymin], axis=-1), 2), valid
+    return np.trunc(np.stack([xmin, ymin, xmax, ymax], axis=-1)).astype(int), valid
+
 # Cell
 def ring_float_to_class_int(rings:float, step=0.1):
     """Ring value rounded to classifier value; rounded to nearest step size"""
@@ -252,6 +440,18 @@ def crop_to_bbox(
         print(f"crop_to_bbox: Error: zero-dim crop request, crop_bb = {crop_bb}. Returning None.")
         return None
 
+# Cell
+def ann_df_to_crop_bboxes(
+    df,                    # DataFrame of ellipses for one image, with columns cx, cy, a, b, angle, rings
+    width=512, height=384, # image dimensions
+    ):
+    "Returns xyxy bboxes & ring counts for the antinodes that get crops, and how many were skipped for zero-size bboxes"
+    df = normalize_ann_df(df)
+    rings = np.array([round(float(r),2) for r in df['rings']])
+    has_rings = rings > 0
+    bboxes, valid = ellipse_to_bbox_batch(*[df[c].values[has_rings] for c in _ann_cols[:5]], width=width, height=height)
+    return bboxes[valid], rings[has_rings][valid], int((~valid).sum())
+
 # Cell
 def is_in_box(
     p,     # a point as a (x,y) coordinate pair
@@ -298,4 +498,223 @@ def kfold_split(
     else:   # last one might be a bit different
         val_list = data[k*val_size:]
         train_list = data[0:-len(val_list)]
-    return train_list, val_list
\ No newline at end of file
+    return train_list, val_list
+
+# Cell
+def _run_one(func, item):
+    "Runs func on one (index, args) work item; hands back errors instead of raising them in the worker"
+    i, args = item
+    try:
+        return i, True, func(*args)
+    except Exception as e:
+        return i, False, f"{type(e).__name__}: {e}"
+
+# Cell
+def parallel_imap(
+    func,            # (module-level) function to run on each work item, as func(*item)
+    items,           # list of work items, each a tuple of arguments
+    jobs=0,          # number of worker processes. 0 = number of CPU cores, 1 = don't use multiprocessing
+    chunksize=None,  # how many items to send to a worker at a time. None = choose based on len(items) & jobs
+    quiet=False,     # don't print progress messages
+    desc='',         # label to put in front of progress messages
+    ordered=True,    # yield results in the order of items. False = as soon as they're done
+    ):
+    "Generator version of `parallel_map`: yields (index, ok, result or error message) for each work item"
+    n = len(items)
+    jobs = jobs if jobs > 0 else mp.cpu_count()
+    work = partial(_run_one, func)
+    pool, n_errors = None, 0
+    if jobs == 1 or n <= 1:
+        results_iter = map(work, enumerate(items))
+    else:
+        if chunksize is None: chunksize = max(1, min(64, n // (4*jobs)))  # a few chunks per worker, to balance load
+        pool = mp.Pool(jobs)
+        results_iter = (pool.imap if ordered else pool.imap_unordered)(work, enumerate(items), chunksize=chunksize)
+    report_every = max(1, n // 20)
+    try:
+        for done, (i, ok, result) in enumerate(results_iter, 1):
+            if not ok:
+                n_errors += 1
+                print(f"{desc}Error on item {i}: {result}", flush=True)
+            if (not quiet) and ((done % report_every == 0) or (done == n)):
+                print(f"{desc}{done}/{n} done", flush=True)
+            yield i, ok, result
+    except BaseException:   # Ctrl-C, generator closed early, or an error in the caller: don't wait for queued items
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if n_errors > 0: print(f"{desc}{n_errors} of {n} items had errors")
+
+# Cell
+def parallel_map(
+    func,            # (module-level) function to run on each work item, as func(*item)
+    items,           # list of work items, each a tuple of arguments
+    jobs=0,          # number of worker processes. 0 = number of CPU cores, 1 = don't use multiprocessing
+    chunksize=None,  # how many items to send to a worker at a time. None = choose based on len(items) & jobs
+    quiet=False,     # don't print progress messages
+    desc='',         # label to put in front of progress messages
+    ):
+    "Runs func over items with a process pool. Returns list of results (in order of items) and list of (index, error message)"
+    results, errors = [None]*len(items), []
+    for i, ok, result in parallel_imap(func, items, jobs=jobs, chunksize=chunksize, quiet=quiet, desc=desc, ordered=False):
+        if ok: results[i] = result
+        else:  errors.append((i, result))
+    return results, errors
+
+# Cell
+crop_index_cols = ['shard', 'offset', 'size', 'name', 'source', 'xmin', 'ymin', 'xmax', 'ymax', 'rings']
+
+# Cell
+class CropShards():
+    "Crops packed in tar shards by `gen_crops --shard`. Index it like a list, or iterate over it, to get (PIL image, rings)"
+    def __init__(self,
+        path,                         # directory with the index file & the shards
+        index_file='crops_index.csv', # index file written by gen_crops
+        ):
+        self.path = Path(path)
+        self.index = pd.read_csv(self.path/index_file)
+        self.shards, self.offsets, self.sizes = [self.index[c].values for c in ['shard', 'offset', 'size']]
+        self.rings = self.index['rings'].values
+        self._files, self._pid = {}, None
+
+    def __len__(self): return len(self.index)
+
+    def __getstate__(self):   # open files don't pickle, e.g. when handing this to DataLoader workers
+        return {k: v for k, v in self.__dict__.items() if k not in ['_files', '_pid']}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._files, self._pid = {}, None
+
+    def _file(self, shard):
+        if self._pid != os.getpid(): self._files, self._pid = {}, os.getpid()  # don't share file positions with a forked parent
+        if shard not in self._files: self._files[shard] = open(self.path/shard, 'rb')
+        return self._files[shard]
+
+    def get_bytes(self, i):
+        "PNG-encoded bytes of crop i"
+        f = self._file(self.shards[i])
+        f.seek(self.offsets[i])
+        return f.read(self.sizes[i])
+
+    def __getitem__(self, i):
+        return Image.open(io.BytesIO(self.get_bytes(i))), self.rings[i]
+
+    def __iter__(self):
+        "Goes through the crops in index order, reading each shard in one go"
+        i, n = 0, len(self)
+        while i < n:
+            j = i
+            while j < n and self.shards[j] == self.shards[i]: j += 1
+            with open(self.path/self.shards[i], 'rb') as f: data = f.read()
+            for k in range(i, j):
+                yield Image.open(io.BytesIO(data[self.offsets[k]:self.offsets[k]+self.sizes[k]])), self.rings[k]
+            i = j
+
+# Cell
+class CropDataset():
+    "Crops of each antinode, cut from the full frames on the fly instead of read from `gen_crops` output. Items are (PIL image, rings)"
+    def __init__(self,
+        files='annotations/*.csv', # wildcard name for the annotation CSV files
+        index='',                  # read annotations via this annotation index file (see `build_ann_index`). '' = read the CSVs
+        size=None,                 # resize (squish) crops to this, e.g. 300 or (width,height). None = don't resize
+        pad=0,                     # grow each bbox by this many pixels on every side
+        cache_frames=64,           # max number of decoded full frames to keep in memory (~600KB each)
+        img_bank='images/',        # where the images are, if not next to the CSV files
+        ):
+        meta_file_list = sorted(glob.glob(files))
+        if index: dfs = split_ann_index(build_ann_index(files, index, quiet=True), meta_file_list)
+        else:     dfs = [pd.DataFrame(_read_ann_csv(f), columns=_ann_cols) for f in meta_file_list]
+        self.img_files = [meta_to_img_path(f, img_bank=img_bank) for f in meta_file_list]
+        per_frame = [ann_df_to_crop_bboxes(df)[:2] for df in dfs]
+        self.frame_idx = np.concatenate([[j]*len(bbs) for j, (bbs, _) in enumerate(per_frame)] + [[]]).astype(int)
+        self.bboxes = np.concatenate([bbs for bbs, _ in per_frame] + [np.zeros((0,4), dtype=int)])
+        self.rings = np.concatenate([rings for _, rings in per_frame] + [[]])
+        self.size = (size, size) if isinstance(size, int) else size
+        self.pad, self.cache_frames = pad, cache_frames
+        self._cache = OrderedDict()
+
+    def __len__(self): return len(self.rings)
+
+    def __getstate__(self):   # don't ship cached frames off to DataLoader workers
+        return {k: (OrderedDict() if k == '_cache' else v) for k, v in self.__dict__.items()}
+
+    def get_frame(self, j):
+        "Decoded full frame j, via the LRU cache"
+        if j in self._cache: self._cache.move_to_end(j)
+        else:
+            img = Image.open(self.img_files[j])
+            img.load()
+            self._cache[j] = img
+            if len(self._cache) > self.cache_frames: self._cache.popitem(last=False)
+        return self._cache[j]
+
+    def __getitem__(self, i):
+        bb = self.bboxes[i] + np.array([-1, -1, 1, 1])*self.pad
+        crop = crop_to_bbox(self.get_frame(self.frame_idx[i]), bb)
+        if self.size is not None: crop = crop.resize(self.size, Image.BILINEAR)
+        return crop, self.rings[i]
+
+# Cell
+def tiled_segreg_name(npy_file): return re.sub(r'\.npy$', '', str(npy_file))+'_tiled.npy'
+
+def tile_segreg_volume(
+    npy_file,             # (frames, height, width) .npy file
+    tiled_file=None,      # where to write the tiled copy. None = `tiled_segreg_name(npy_file)`
+    tile=16,              # tiles are tile x tile pixels
+    frames_per_pass=512,  # number of frames to read & rearrange at a time
+    ):
+    "Copies a seg-reg volume into (tile rows, tile cols, tile, tile, frames) layout, a few frames at a time. Returns name of the copy"
+    vol = np.load(npy_file, mmap_mode='r')
+    T, H, W = vol.shape
+    nty, ntx = -(-H//tile), -(-W//tile)   # edge tiles get padded with zeros
+    tiled_file = tiled_file or tiled_segreg_name(npy_file)
+    tmp_file = re.sub(r'\.npy$', '', tiled_file)+'.tmp.npy'
+    out = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=vol.dtype, shape=(nty, ntx, tile, tile, T))
+    buf = np.zeros((min(frames_per_pass, T), nty*tile, ntx*tile), vol.dtype)
+    for t0 in range(0, T, frames_per_pass):
+        n = min(frames_per_pass, T-t0)
+        buf[:n, :H, :W] = vol[t0:t0+n]
+        out[..., t0:t0+n] = buf[:n].reshape(n, nty, tile, ntx, tile).transpose(1, 3, 2, 4, 0)
+    out.flush()
+    del out
+    with open(re.sub(r'\.npy$', '', tiled_file)+'.json', 'w') as f: json.dump({'shape': [T, H, W]}, f)
+    os.replace(tmp_file, tiled_file)
+    return tiled_file
+
+# Cell
+class SegregVolume():
+    "Memory-mapped (frames, height, width) seg-reg volume, read via its tiled copy from `tile_segreg_volume` if there's one"
+    def __init__(self,
+        path,        # .npy file of the volume, frame-major
+        tiled=None,  # read the tiled copy? None = if there's one that's newer than path
+        ):
+        self.path, tiled_file = str(path), tiled_segreg_name(path)
+        info_file = re.sub(r'\.npy$', '', tiled_file)+'.json'
+        if tiled is None:
+            tiled = os.path.exists(tiled_file) and os.path.exists(info_file) and (os.path.getmtime(tiled_file) >= os.path.getmtime(path))
+        self.frames, self.tiles = None, None
+        if tiled:
+            self.tiles = np.load(tiled_file, mmap_mode='r')
+            with open(info_file) as f: self.shape = tuple(json.load(f)['shape'])
+        else:
+            self.frames = np.load(path, mmap_mode='r')
+            self.shape = self.frames.shape
+
+    def __len__(self): return self.shape[0]
+
+    def time_series(self, y, x):
+        "Values at pixel (y,x) in every frame"
+        if self.tiles is None: return np.array(self.frames[:, y, x])
+        th, tw = self.tiles.shape[2:4]
+        return np.array(self.tiles[y//th, x//tw, y%th, x%tw])
+
+    def frame(self, t):
+        "Frame number t, as a (height, width) array"
+        if self.tiles is None: return np.array(self.frames[t])
+        nty, ntx, th, tw = self.tiles.shape[:4]
+        return self.tiles[..., t].transpose(0, 2, 1, 3).reshape(nty*th, ntx*tw)[:self.shape[1], :self.shape[2]]
\ No newline at end of file
@@ -63,6 +63,8 @@ from espiownage.core import *
 from itertools import cycle
 from collections import defaultdict
 import matplotlib.pyplot as plt
+import threading
+import json
 
 
 
@@ -70,42 +72,142 @@ def increment(num, digits,step):
     # return the first part of match as is, Return the 2nd match + 1 which is 'x + 1'
     return num.group(1) + str(int(num.group(2)) + step).zfill(digits)
 
-def get_next_img(meta_file, step=1, img_bank='images/'):
-    "Increments the number of the image filename and tries to load it"
+def read_next_img(meta_file, step=1, img_bank='images/'):
+    "Increments the number of the image filename and tries to load it. Returns (PIL image, path), blank if there's none"
     digits = len(Path(meta_file).stem.split('_')[-1]) # num digits in ending number part of the name
     next_meta = re.sub('(proc_)([0-9]{'+str(digits)+'})', lambda m: increment(m,digits,step), meta_file)
     next_img_path = meta_to_img_path(next_meta, img_bank=img_bank)
     if os.path.exists(str(next_img_path)):
-        return ImageTk.PhotoImage(image=Image.open(next_img_path)), str(next_img_path)
-    blank_img = Image.new('RGB', (512, 384), (255, 255, 255))
-    return ImageTk.PhotoImage(image=blank_img), 'None'
-
+        img = Image.open(next_img_path)
+        img.load()   # decode now, not when it's first drawn
+        return img, str(next_img_path)
+    return Image.new('RGB', (512, 384), (255, 255, 255)), 'None'
 
+def get_next_img(meta_file, step=1, img_bank='images/'):
+    "Increments the number of the image filename and tries to load it"
+    img, name = read_next_img(meta_file, step, img_bank=img_bank)
+    return ImageTk.PhotoImage(image=img), name
+
+
+def read_pred_mask(meta_file, width=512, height=384):
+    "Reads & colorizes the predicted segmentation mask for meta_file, if there is one. Returns (mask file, mask or None)"
+    mask_pred_file = 'top_losses/seg_images/'+str(Path(meta_file).stem)+'_pred.png'
+    if not os.path.exists(mask_pred_file): return mask_pred_file, None
+    mask_img = Image.open(mask_pred_file)
+    if mask_img.size != (width, height): # to allow for half-size masks
+        mask_img = mask_img.resize((width, height))
+    return mask_pred_file, ImageOps.colorize(mask_img, black ="black", white =(150,0,150))
+
+
+def read_ellipses(meta_file):
+    "Reads ellipses from a CSV file into a DataFrame"
+    col_names = ['cx', 'cy', 'a', 'b', 'angle', 'rings']
+    df = pd.read_csv(meta_file,header=None,names=col_names)  # read metadata file
+    df.drop_duplicates(inplace=True)  # sometimes the data from Zooniverse has duplicate rows
+    return df
+
+
+def read_frame(meta_file, img_bank='images/', width=512, height=384,
+    has_mask=None):   # whether there's a predicted mask, if we know. None = go look
+    "Reads, decodes & colorizes everything the editor shows for one file. No Tk calls, so it can run in a background thread"
+    image = ImageOps.colorize(Image.open(meta_to_img_path(meta_file, img_bank=img_bank)), black ="black", white ="white")
+    mask_pred_file, mask_img = read_pred_mask(meta_file, width, height) if has_mask is not False else ('', None)
+    return {'image': image, 'mask_pred_file': mask_pred_file, 'mask_img': mask_img,
+            'blended': Image.blend(image, mask_img, 0.5) if mask_img else None,
+            'prev': read_next_img(meta_file, -1, img_bank=img_bank), 'next': read_next_img(meta_file, 1, img_bank=img_bank),
+            'df': read_ellipses(meta_file)}
+
+
+class FramePrefetcher():
+    """Keeps frames from read_frame for the files around the current one in meta_file_list, read ahead of time by a
+    background thread, so that going to the next or previous file is just a lookup. Frames farthest from the current
+    one get dropped first, so it works like a ring buffer that moves along with the current file. Each file has a
+    generation count that forget bumps, so a frame read before its file was forgotten gets dropped, not kept"""
+    def __init__(self, meta_file_list, img_bank='images/', ahead=8, width=512, height=384,
+        overlays=None):   # OverlayIndex, to know which frames have predicted masks without looking for them
+        self.meta_file_list, self.img_bank, self.ahead, self.size = meta_file_list, img_bank, ahead, (width, height)
+        self.overlays = overlays
+        self.frames = {}                         # file index -> frame
+        self.generation = defaultdict(int)       # file index -> number of times it's been forgotten
+        self.maxlen = 2*(2*ahead+1)              # room to go back & forth without reading things again
+        self.lock, self.wake = threading.Lock(), threading.Event()
+        self.current = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _dist(self, i, j):
+        "Number of arrow-key presses from file i to file j (the list wraps around)"
+        d = abs(i - j) % len(self.meta_file_list)
+        return min(d, len(self.meta_file_list) - d)
+
+    def _put(self, i, frame, generation):
+        "Keeps frame for file i, unless file i was forgotten since it was read (i.e. generation is out of date)"
+        with self.lock:
+            if generation != self.generation[i]: return
+            self.frames[i] = frame
+            while len(self.frames) > self.maxlen:
+                del self.frames[max(self.frames, key=lambda j: self._dist(j, self.current))]
+
+    def _read(self, i):
+        meta_file = self.meta_file_list[i]
+        has_mask = None if self.overlays is None else self.overlays.has_pred_mask(meta_file)
+        return read_frame(meta_file, img_bank=self.img_bank, width=self.size[0], height=self.size[1], has_mask=has_mask)
+
+    def get(self, i):
+        "The frame for meta_file_list[i]: from the buffer if it's there, else read now. Then reads ahead around it"
+        self.current = i
+        with self.lock: frame, generation = self.frames.get(i), self.generation[i]
+        if frame is None:
+            frame = self._read(i)
+            self._put(i, frame, generation)
+        self.wake.set()
+        return frame
+
+    def forget(self, i):
+        "Drop file i from the buffer, e.g. after its annotations were saved"
+        with self.lock:
+            self.frames.pop(i, None)
+            self.generation[i] += 1
+
+    def _run(self):
+        n = len(self.meta_file_list)
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            current = self.current
+            for k in range(1, min(self.ahead, n//2)+1):    # nearest first, alternating forward & back
+                if self.current != current: break          # user moved on: start again from there
+                for i in [(current+k) % n, (current-k) % n]:
+                    with self.lock: have, generation = (i in self.frames), self.generation[i]
+                    if have: continue
+                    try: self._put(i, self._read(i), generation)
+                    except Exception as e: print(f"FramePrefetcher: couldn't read {self.meta_file_list[i]}: {e}")
+
+
+
+_unit_circles = {}   # steps -> (cos, sin) of the angles of that many points around a circle
 
 def poly_oval(cx, cy, a, b, angle=0, steps=100 ):
     # From https://mail.python.org/pipermail/python-list/2000-December/022013.html
     """return an oval as coordinates suitable for create_polygon"""
+    if steps not in _unit_circles:
+        theta = (math.pi * 2) * (np.arange(steps) / steps)  # theta is for points drawing the circumference of the ellipse
+        _unit_circles[steps] = (np.cos(theta), np.sin(theta))
+    cos_t, sin_t = _unit_circles[steps]
 
     # angle is in degrees anti-clockwise, convert to radians
     rotation = angle * math.pi / 180.0  # overall angle of the ellipse
+    cos_r, sin_r = math.cos(rotation), math.sin(rotation)
 
-    point_list = []
-
-    # create the oval as a list of points
-    for i in range(steps):
-
-        # Calculate the angle for this step: 360 degrees == 2 pi radians
-        theta = (math.pi * 2) * (float(i) / steps)  # theta is for points drawing the circumference of the ellipse
-        x1, y1 = a * math.cos(theta), b * math.sin(theta)
+    # rotate x, y of all the points at once, and interleave them
+    points = np.empty((steps, 2))
+    points[:,0] = (a*cos_r)*cos_t + (b*sin_r)*sin_t + cx
+    points[:,1] = (b*cos_r)*sin_t - (a*sin_r)*cos_t + cy
+    return points.ravel().tolist()
 
-        # rotate x, y
-        x = (x1 * math.cos(rotation)) + (y1 * math.sin(rotation))
-        y = (y1 * math.cos(rotation)) - (x1 * math.sin(rotation))
 
-        point_list.append((x + cx))
-        point_list.append((y + cy))
-
-    return point_list
+def oval_steps(a, b, px_per_step=6, min_steps=16, max_steps=100):
+    "Number of points for an oval that's smooth enough for its size, e.g. while it's being dragged: about one per px_per_step pixels of perimeter"
+    return int(np.clip(math.pi*(a+b)/px_per_step, min_steps, max_steps))
 
 
 def clean_pandas_list(list_):
@@ -144,6 +246,127 @@ def get_top_loss_list(
     return dedup_list(top_loss_list)
 
 
+def overlay_sources(tldir='top_losses/'):
+    "Prediction files the editor overlays on frames: bboxes CSV, ring-count CSV, directory of predicted masks (None if missing)"
+    tldir = (tldir or 'top_losses').rstrip('/')
+    bbox_file = tldir+'/bboxes_top_losses_real.csv'
+    tl_rc_files = glob.glob(tldir+'/*ring*.csv')   # not sure I'll keep the same name. something ring-related
+    mask_dir = tldir+'/seg_images'
+    return {'bboxes': bbox_file if os.path.exists(bbox_file) else None,
+            'rings':  tl_rc_files[0] if len(tl_rc_files) > 0 else None,
+            'masks':  mask_dir if os.path.isdir(mask_dir) else None}
+
+
+def _numbers(s, per=4):
+    "All the numbers in a string like '[[1, 2, 3, 4], [5, 6, 7, 8]]', as (n,per) array"
+    return np.array(re.findall(r'-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?', s), np.float32).reshape(-1, per)
+
+
+def overlay_arrays(sources):
+    """The prediction overlays for all frames, as arrays: names (sorted frame CSV names), bbox_offsets & ring_offsets
+    (frame i's rows are offsets[i]:offsets[i+1]), bbox_data (n,4), ring_data (n,5: bbox & predicted ring count),
+    has_mask (bool per frame)"""
+    bbox_rows, ring_rows, masked = {}, defaultdict(list), set()
+    if sources['bboxes']:
+        df = pd.read_csv(sources['bboxes']).drop_duplicates('filename')   # the editor only ever showed the first row
+        bbox_rows = {name: _numbers(bblist) for name, bblist in zip(df['filename'], df['bblist'].astype(str))}
+    if sources['rings']:
+        df = pd.read_csv(sources['rings'])
+        for filename, pred in zip(df['filename'], df['prediction']):
+            parts = filename.split('_')[-5:]
+            ring_rows[meta_from_str(filename)].append([int(x) for x in parts[0:4]] + [float(pred)])
+    if sources['masks']:
+        masked = set(f[:-len('_pred.png')]+'.csv' for f in os.listdir(sources['masks']) if f.endswith('_pred.png'))
+    names = sorted(set(bbox_rows) | set(ring_rows) | masked)
+
+    def ragged(rows, width):   # concatenated rows for all frames, and where each frame's rows start
+        counts = [len(rows.get(name, [])) for name in names]
+        data = np.concatenate([np.array(rows[name], np.float32).reshape(-1, width) for name in names if name in rows] + [np.zeros((0, width), np.float32)])
+        return data, np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    arrays = dict(zip(['bbox_data', 'bbox_offsets'], ragged(bbox_rows, 4)))
+    arrays.update(zip(['ring_data', 'ring_offsets'], ragged(ring_rows, 5)))
+    arrays['names'] = np.array(names, dtype='S') if names else np.zeros(0, 'S1')
+    arrays['has_mask'] = np.array([name in masked for name in names], bool)
+    return arrays
+
+
+def compile_overlays(sources, index_dir):
+    "Compiles the arrays from overlay_arrays into index_dir, as .npy files, plus sources.json"
+    arrays = overlay_arrays(sources)
+    mkdir_if_needed(index_dir)
+    for key, arr in arrays.items(): np.save(index_dir+'/'+key+'.npy', arr)
+    with open(index_dir+'/sources.json', 'w') as f: json.dump(_source_stamps(sources), f)   # last, so it marks a complete index
+
+
+def _source_stamps(sources):
+    "Enough about the source files to tell if they've changed"
+    return {k: None if v is None else [v, os.path.getmtime(v), os.path.getsize(v)] for k, v in sources.items()}
+
+
+class OverlayIndex():
+    """Prediction overlays (bboxes, ring counts, whether there's a predicted mask) for each frame, from an index
+    compiled by compile_overlays the first time (and whenever the prediction files change).
+    Arrays are memory-mapped when first needed, and frames are found by binary search on their sorted names.
+    If there are no prediction files at all, nothing gets compiled or written, and every frame has no overlays"""
+    def __init__(self, tldir='top_losses/', index_dir=None):
+        sources = overlay_sources(tldir)
+        self.index_dir = index_dir or (tldir or 'top_losses').rstrip('/')+'/overlay_index'
+        if all(v is None for v in sources.values()):   # nothing to overlay: just use (empty) arrays in memory
+            self._arrays = overlay_arrays(sources)
+            return
+        self._arrays = {}
+        stamp_file = self.index_dir+'/sources.json'
+        if os.path.exists(stamp_file):
+            with open(stamp_file) as f: up_to_date = json.load(f) == json.loads(json.dumps(_source_stamps(sources)))
+        else: up_to_date = False
+        if not up_to_date:
+            print("Compiling prediction overlays into",self.index_dir)
+            compile_overlays(sources, self.index_dir)
+
+    def __getattr__(self, key):   # names, bbox_data, bbox_offsets, etc.: memory-map them the first time they're used
+        if key.startswith('_'): raise AttributeError(key)
+        if key not in self._arrays: self._arrays[key] = np.load(self.index_dir+'/'+key+'.npy', mmap_mode='r')
+        return self._arrays[key]
+
+    def row(self, meta_file):
+        "Index of meta_file's frame, or None if there are no predictions for it"
+        key = os.path.basename(meta_file).encode()
+        i = int(np.searchsorted(self.names, key))
+        return i if (i < len(self.names)) and (self.names[i] == key) else None
+
+    def _rows(self, data, offsets, meta_file):
+        i = self.row(meta_file)
+        return data[0:0] if i is None else data[offsets[i]:offsets[i+1]]
+
+    def bboxes(self, meta_file): return self._rows(self.bbox_data, self.bbox_offsets, meta_file)
+    def rings(self, meta_file):  return self._rows(self.ring_data, self.ring_offsets, meta_file)
+    def has_pred_mask(self, meta_file):
+        i = self.row(meta_file)
+        return (i is not None) and bool(self.has_mask[i])
+
+
+class Ellipse():
+    "One ellipse in the editor: its shape (in image coordinates) & ring count"
+    __slots__ = ['cx', 'cy', 'a', 'b', 'angle', 'rings']
+    col_names = ['cx', 'cy', 'a', 'b', 'angle', 'rings']
+
+    def __init__(self, cx, cy, a, b, angle, rings):
+        self.cx, self.cy, self.a, self.b, self.angle, self.rings = cx, cy, a, b, angle, rings
+
+    def row(self):
+        "cx, cy, a, b, angle (rounded, and with a > b), rings: as written to the CSV file"
+        a, b, angle = fix_abangle(self.a, self.b, self.angle % 180)
+        return [int(round(x)) for x in [self.cx, self.cy, a, b, angle]] + [self.rings]
+
+
+def ellipses_table(rows, col_names=Ellipse.col_names):
+    "Text table of rows, one line per ellipse, for the readout"
+    cols = list(zip(col_names, *rows))
+    widths = [max(len(str(x)) for x in col) for col in cols]
+    return '\n'.join(' '.join(str(x).rjust(w) for x, w in zip(line, widths)) for line in zip(*cols))
+
+
 class EllipseEditor(tk.Frame):
     '''Edit ellipses for steelpan images'''
 
@@ -152,6 +375,7 @@ class EllipseEditor(tk.Frame):
         img_bank='images/',     # where images are stored
         tldir=None,        # directory where top-losses info is stored
         seq=True,               # ignore top losses and do sequential selection of frames (per existing annotations)
+        prefetch=8,             # number of files ahead & behind to read in the background
         ):
         tk.Frame.__init__(self, parent)
         self.meta_file_list = meta_file_list
@@ -160,6 +384,8 @@ class EllipseEditor(tk.Frame):
         if self.top_loss_list == []: seq = True
         if not seq: self.meta_file_list = combine_file_and_tl_lists(self.meta_file_list, self.top_loss_list)
         self.seq = seq
+        self.overlays = OverlayIndex(tldir)   # predicted bboxes, ring counts & masks for each frame
+        self.prefetcher = FramePrefetcher(self.meta_file_list, img_bank=self.img_bank, ahead=prefetch, overlays=self.overlays)
 
         # create a canvas
         self.width, self.height = 512, 384   # size of images
@@ -177,27 +403,18 @@ class EllipseEditor(tk.Frame):
         self.mask_img = None
         self.showing_mask = True
 
-        self.bbox_pred_file = 'top_losses/bboxes_top_losses_real.csv' # TODO: this is fragile
         self.showing_bboxes = True
         self.bbox_list = []
-        self.bbox_df = pd.read_csv(self.bbox_pred_file, converters={'bblist': eval})
-        self.bbox_df.apply(clean_pandas_list)
 
         self.segreg_volume_file = 'segreg_volume_f16.npy'
-        self.segreg_volume = []
+        self.segreg_volume = None
         if os.path.exists(self.segreg_volume_file):
             print("Reading seg-reg volume data file ",self.segreg_volume_file)
-            # read file as memory-mapped object, cf. https://numpy.org/doc/stable/reference/generated/numpy.memmap.html#numpy.memmap
-            self.segreg_volume = np.load(self.segreg_volume_file)#, mmap_mode="r")
-            self.segreg_volume_times = np.arange(self.segreg_volume.shape[0]) #/self.fps
+            # memory-mapped, & via the tiled copy from tile_segreg_volume if there is one: fast time series for each pixel
+            self.segreg_volume = SegregVolume(self.segreg_volume_file)
+            self.segreg_volume_times = np.arange(len(self.segreg_volume)) #/self.fps
             #print("self.segreg_volume.shape =",self.segreg_volume.shape)
 
-        self.tl_ring_count_file, self.tl_ring_count_dict = '', {}
-        self.tl_ring_count_dict = defaultdict(lambda: [], self.tl_ring_count_dict) # map filenames to lists of rings info; defaults to empty list
-        tl_rc_files = glob.glob(tldir+'/*ring*.csv')
-        if len(tl_rc_files) > 0:
-            self.tl_ring_count_file = tl_rc_files[0] # not sure I'll keep the same name. something ring-related
-            self.setup_tl_ring_count_dict()
         self.showing_predrings, self.predringlist = True, []  # thing we actually use
 
         self.color = "green"
@@ -205,8 +422,10 @@ class EllipseEditor(tk.Frame):
         # this data is used to keep track of an item being dragged
         self._drag_data = {"x": 0, "y": 0, "items": None}
 
-        self._token_data = []
+        self.ellipses = {}      # canvas tag -> Ellipse, for each ellipse on the canvas
         self._numtokens = 0
+        self._readout_job = None   # pending redraw of the readout, if any
+        self.readout_ms = 16       # redraw the readout at most this often (about once per display refresh)
         self.hr = 4             # handle radius
 
         # Define global event bindings
@@ -232,39 +451,31 @@ class EllipseEditor(tk.Frame):
         self.canvas.bind("<Right>", self.on_rightarrow)
         self.canvas.bind('<Motion>', self.mouse_move)
 
+        self._fonts = {}
         self.infostr = ""
         self.text = self.canvas.create_text(self.width+10, 10+self.height, text=self.infostr,
-            anchor=tk.NW, font=tk.font.Font(size=15,family='Consolas'))
+            anchor=tk.NW, font=self.font(15,'Consolas'))
         self.df = ''
+        self.image_id = self.canvas.create_image(self.width/2, self.y0 + self.height/2)   # made once, then assign_image updates it
 
         self.load_new_files()
 
 
-    def setup_tl_ring_count_dict(self):
-        "this will store info about all the antinode ring counts for each file, as a list of lists for each file"
-        df = pd.read_csv(self.tl_ring_count_file)
-        #print(df.head())
-        for i, row in df.iterrows(): # stop telling me stop using iterrows, it's clear coding ;-)
-            meta, parts = meta_from_str(row['filename']), row['filename'].split('_')[-5:]
-            bbox, rings = [int(x) for x in parts[0:4]], float(row['prediction'])
-            bb_rings = bbox + [rings]
-            if len(self.tl_ring_count_dict[meta]) == 0: self.tl_ring_count_dict[meta] = [bb_rings]
-            else: self.tl_ring_count_dict[meta].append(bb_rings)
+    def font(self, size, family=None):
+        "The same tk Font object every time for the same size & family, instead of making new ones"
+        if (size, family) not in self._fonts:
+            self._fonts[(size, family)] = tk.font.Font(size=size, family=family) if family else tk.font.Font(size=size)
+        return self._fonts[(size, family)]
 
-    def setup_pred_mask(self):
-        self.mask_img = None
-        self.mask_pred_file = 'top_losses/seg_images/'+str(Path(self.meta_file).stem)+'_pred.png'
-        if os.path.exists(self.mask_pred_file):
-            self.mask_img = Image.open(self.mask_pred_file)
-            if self.mask_img.size != (self.width, self.height): # to allow for half-size masks
-                self.mask_img.size = self.mask_img.size.resize((self.width, self.height))
-            self.mask_img = ImageOps.colorize(self.mask_img, black ="black", white =(150,0,150))
+    def setup_pred_mask(self, frame):
+        self.mask_pred_file, self.mask_img = frame['mask_pred_file'], frame['mask_img']
+        self.blended = frame['blended']
         return
 
     def merge_mask_image(self):
         if not self.mask_img: return
         if self.showing_mask:
-            self.image = Image.blend(self.image, self.mask_img, 0.5)
+            self.image = self.blended
             self.assign_image()
 
     def draw_pred_rings(self):
@@ -272,11 +483,11 @@ class EllipseEditor(tk.Frame):
         for bbr in self.predringlist:
             cx, cy, ringstr = int((bbr[0]+bbr[2])/2), int((bbr[1]+bbr[3])/2), '{0:.1f}'.format(bbr[-1])
             #print("predicted ring counts: ",cx, cy, ringstr)
-            ringtext = self.canvas.create_text(cx, self.y0+cy-15, text=ringstr, anchor=tk.CENTER, font=tk.font.Font(size=15), fill="yellow")
+            ringtext = self.canvas.create_text(cx, self.y0+cy-15, text=ringstr, anchor=tk.CENTER, font=self.font(15), fill="yellow")
 
     def draw_pred_bboxes(self, please_fix=True):
         if (not self.showing_bboxes) or len(self.bbox_list)==0: return
-        for bb in self.bbox_list[0]:
+        for bb in self.bbox_list:
             if please_fix:
                 # icevision shrank our images and then ebedded them in 384,384, we need to undo that?
                 bb = [int(x*512/384) for x in bb]  # unshrink everything
@@ -284,39 +495,40 @@ class EllipseEditor(tk.Frame):
             box = self.canvas.create_rectangle(bb[0],bb[1],bb[2],bb[3], outline="cyan", width=2)
 
     def load_new_files(self):
-        self.canvas.delete("all")  #destroy old tokens
+        self.canvas.delete(*[i for i in self.canvas.find_all() if i != self.image_id])  #destroy old tokens, but keep the image item
+        self.ellipses = {}
         self.text = self.canvas.create_text(self.width+10, 10+self.y0, text=self.infostr,
-            anchor=tk.NW, font=tk.font.Font(size=15,family='Consolas'))
+            anchor=tk.NW, font=self.font(15,'Consolas'))
+        # mouse coordinates readout: made once per file, and then just updated
+        tx, ty = 2*self.width+40, 2*self.height-40
+        self.coords_box = self.canvas.create_rectangle(tx-5,ty, tx+110,ty+25, fill="white", outline="white")
+        self.coords_text = self.canvas.create_text(tx, ty, text='', anchor=tk.NW, font=self.font(12), fill='black')
         self.meta_file = self.meta_file_list[self.file_index]
         self.img_file = meta_to_img_path(self.meta_file, img_bank=self.img_bank)
-        self.setup_pred_mask()
-        self.read_assign_image()
+        frame = self.prefetcher.get(self.file_index)   # usually already read, in the background
+        self.setup_pred_mask(frame)
+        self.read_assign_image(frame)
         self.merge_mask_image()
 
-        self.read_prev_next_imgs()
-        self.bbox_list = self.bbox_df[self.bbox_df['filename'] == os.path.basename(self.meta_file)]['bblist'].tolist() # nice, huh? ;-)
+        self.read_prev_next_imgs(frame)
+        self.bbox_list = self.overlays.bboxes(self.meta_file)
         self.draw_pred_bboxes()
-        self.predringlist = self.tl_ring_count_dict[os.path.basename(self.meta_file)]
+        self.predringlist = self.overlays.rings(self.meta_file)
         self.draw_pred_rings()
-        self.read_assign_csv()
+        self.read_assign_csv(frame['df'])
 
 
     def assign_image(self):
-        self.tkimage = ImageTk.PhotoImage(image=self.image)
-        self.label = tk.Label(image=self.tkimage)
-        self.label.image = self.tkimage # keep a reference!
-        self.canvas.create_image(self.width/2, self.y0 + self.height/2, image=self.tkimage)
-
-    def read_assign_image(self):
-        self.image = Image.open(self.img_file)
-        self.image = ImageOps.colorize(self.image, black ="black", white ="white")
+        self.tkimage = ImageTk.PhotoImage(image=self.image)   # keep a reference, or tk won't show it
+        self.canvas.itemconfig(self.image_id, image=self.tkimage)
+
+    def read_assign_image(self, frame):
+        self.image = frame['image']
         self.backup = self.image
         self.assign_image()
 
-    def read_assign_csv(self):
-        col_names = ['cx', 'cy', 'a', 'b', 'angle', 'rings']
-        self.df = pd.read_csv(self.meta_file,header=None,names=col_names)  # read metadata file
-        self.df.drop_duplicates(inplace=True)  # sometimes the data from Zooniverse has duplicate rows
+    def read_assign_csv(self, df):
+        self.df = df
         # assign  ellipse tokens (and their handles)
         for index, row in self.df.iterrows() :
             cx, cy, a, b, angle, rings = row['cx'], row['cy'], row['a'], row['b'], float(row['angle']), row['rings']
@@ -325,18 +537,20 @@ class EllipseEditor(tk.Frame):
                 self._create_token((cx, cy), (a, b), angle, rings, self.color)
         self.update_readout(None)
 
-    def read_prev_next_imgs(self):
+    def read_prev_next_imgs(self, frame):
         # prev image
-        self.prev_img, name = get_next_img(self.meta_file, -1, img_bank=self.img_bank)
+        img, name = frame['prev']
+        self.prev_img = ImageTk.PhotoImage(image=img)
         if self.prev_img: self.canvas.create_image(self.width/2, self.y0 + self.height+20 + self.height/2, image=self.prev_img)
         imlabel = f"Previous Image: {name.split('/')[-1]}"
-        self.canvas.create_text(10, self.y0+self.height, text=imlabel, anchor=tk.NW, font=tk.font.Font(size=12), fill='black')
+        self.canvas.create_text(10, self.y0+self.height, text=imlabel, anchor=tk.NW, font=self.font(12), fill='black')
 
         # next image
-        self.next_img, name = get_next_img(self.meta_file, 1, img_bank=self.img_bank)
+        img, name = frame['next']
+        self.next_img = ImageTk.PhotoImage(image=img)
         if self.next_img: self.canvas.create_image(self.width+20+self.width/2, self.y0 + self.height+20 + self.height/2, image=self.next_img)
         imlabel = f"Next Image: {name.split('/')[-1]}"
-        self.canvas.create_text(self.width+30, self.y0+self.height, text=imlabel, anchor=tk.NW, font=tk.font.Font(size=12), fill='black')
+        self.canvas.create_text(self.width+30, self.y0+self.height, text=imlabel, anchor=tk.NW, font=self.font(12), fill='black')
         return
 
     def _create_token(self, coord, axes, angle, rings, color):
@@ -354,9 +568,9 @@ class EllipseEditor(tk.Frame):
         h_b = self.canvas.create_oval(h_b_x-self.hr, self.y0+h_b_y-self.hr, h_b_x+self.hr, self.y0+h_b_y+self.hr, outline=color, fill="blue", width=3, tags=(thistag,"handle","axis_b"))
 
         ringstr = '{0:.1f}'.format(rings)
-        ringtext = self.canvas.create_text(x-5, self.y0+y-10, text=ringstr, anchor=tk.NW, font=tk.font.Font(size=16), fill=color, tags=(thistag,"ringtext"))
+        ringtext = self.canvas.create_text(x-5, self.y0+y-10, text=ringstr, anchor=tk.NW, font=self.font(16), fill=color, tags=(thistag,"ringtext"))
 
-        self._token_data.append([oval,h_a,h_b,ringtext])
+        self.ellipses[thistag] = Ellipse(x, y, a, b, angle, float(ringstr))
 
         # Define Event Bindings for moving objects around
         self.canvas.tag_bind("main", "<ButtonPress-1>", self.on_main_press)
@@ -368,11 +582,11 @@ class EllipseEditor(tk.Frame):
         self.canvas.tag_bind("handle", "<B1-Motion>", self.on_handle_motion)
 
     def graph_segreg_ts(self,event):
-        if 0 == len(self.segreg_volume): return
+        if self.segreg_volume is None: return
         x, y = event.x, event.y
         if (x>self.width) or (y>self.height): return
         print("graph_segreg_ts: x, y =",x,y)
-        slice = self.segreg_volume[:,y,x]
+        slice = self.segreg_volume.time_series(y, x)
         plt.plot(self.segreg_volume_times, slice, 'o-')
         plt.show()
 
@@ -398,8 +612,9 @@ class EllipseEditor(tk.Frame):
         sys.exit()
     def on_skey(self,event):
         print("Saving file ",self.meta_file)
-        # TODO: add code to enforce a > b (and fix angle)
+        self.df = pd.DataFrame([e.row() for e in self.ellipses.values()], columns=Ellipse.col_names)
         self.df.to_csv(self.meta_file,index=False,header=None)
+        self.prefetcher.forget(self.file_index)   # so coming back here shows what was saved
     def on_rightarrow(self,event):               # right arrow on keyboard
         self.file_index += 1                     # TODO: grab from top_losses
         if (self.file_index >= len(self.meta_file_list)):
@@ -412,9 +627,7 @@ class EllipseEditor(tk.Frame):
         self.load_new_files()
     def mouse_move(self,event):
         x, y = event.x, event.y
-        tx, ty = 2*self.width+40, 2*self.height-40
-        box = self.canvas.create_rectangle(tx-5,ty, tx+110,ty+25, fill="white", outline="white")
-        self.canvas.create_text(tx, ty, text=f'({x},{y})', anchor=tk.NW, font=tk.font.Font(size=12), fill='black')
+        self.canvas.itemconfigure(self.coords_text, text=f'({x},{y})')
 
     def on_main_press(self, event):
         '''Begining drag of an object'''
@@ -429,6 +642,7 @@ class EllipseEditor(tk.Frame):
         # if object is off the screen, delete it
         if ((event.x < 0) or (event.y < 0 ) or (event.x > self.width) or (event.y > self.height)):
             self.canvas.delete(self._drag_data["items"])
+            self.ellipses.pop(self._drag_data["items"], None)
             self.update_readout(None)
         # reset the drag information
         self._drag_data["items"] = None
@@ -442,41 +656,14 @@ class EllipseEditor(tk.Frame):
         delta_y = event.y - self._drag_data["y"]
         # move the object the appropriate amount
         self.canvas.move(self._drag_data["items"], delta_x, delta_y)
+        e = self.ellipses[self._drag_data["items"]]
+        e.cx, e.cy = e.cx + delta_x, e.cy + delta_y
         # record the new position
         self._drag_data["x"] = event.x
         self._drag_data["y"] = event.y
 
 
 
-    def retrieve_ellipse_info(self, tokentag):
-        # retrieves info for whichever single ellipse is currently being manipulated
-        tokenitems = self.canvas.find_withtag( tokentag )
-        [main_id, axis_a_id, axis_b_id, ringtext_id ]= tokenitems
-
-        ell_coords = self.canvas.coords(main_id)   # coordinates of all points in ellipse
-        cxoords, cyoords = ell_coords[0::2],  ell_coords[1::2]
-        cx, cy = np.mean( cxoords ),  np.mean( cyoords )   # coordinates of center of ellipse
-
-        h_a_coords = self.canvas.coords(axis_a_id)
-        h_a_x, h_a_y = np.mean( h_a_coords[0::2] ),  np.mean( h_a_coords[1::2] )
-        a = np.sqrt( (h_a_x - cx)**2 + (h_a_y - cy)**2 )
-
-        h_b_coords = self.canvas.coords(axis_b_id)
-        h_b_x, h_b_y = np.mean( h_b_coords[0::2] ),  np.mean( h_b_coords[1::2] )
-        b = np.sqrt( (h_b_x - cx)**2 + (h_b_y - cy)**2 )
-
-        angle = np.rad2deg( np.arctan2( cy - h_a_y, h_a_x - cx) )
-
-        rings = self.canvas.itemcget(ringtext_id, 'text')
-
-        return cx, cy, a, b, angle, rings, ell_coords
-
-
-    def update_df(self):
-        # iterate through all ellipses -- i.e. tokens with with 'main' tag
-        tokenitems = self.canvas.find_withtag( 'main' )
-
-
     def on_handle_press(self, event):
         '''Begining drag of an handle'''
         # record the item and its location
@@ -488,6 +675,11 @@ class EllipseEditor(tk.Frame):
 
     def on_handle_release(self, event):
         '''End drag of an handle'''
+        # redraw the ellipse with full resolution
+        if self._drag_data["items"] is not None:
+            tokentag = self.canvas.gettags( self._drag_data["items"] )[0]
+            e, main_id = self.ellipses[tokentag], self.canvas.find_withtag( tokentag )[0]
+            self.canvas.coords(main_id, poly_oval(e.cx, self.y0+e.cy, e.a, e.b, angle=e.angle))
         # reset the drag information
         self._drag_data["items"] = None
         self._drag_data["x"] = 0
@@ -505,7 +697,8 @@ class EllipseEditor(tk.Frame):
         # what are the tags for this particular handle
         tags = self.canvas.gettags( self._drag_data["items"] )
         tokentag = tags[0]
-        cx, cy, a, b, angle, rings, coords  = self.retrieve_ellipse_info( tokentag )
+        e = self.ellipses[tokentag]
+        cx, cy, a, b = e.cx, self.y0+e.cy, e.a, e.b
 
         tokenitems = self.canvas.find_withtag( tokentag )
         [main_id, axis_a_id, axis_b_id, ringtext_id ]= tokenitems
@@ -515,16 +708,14 @@ class EllipseEditor(tk.Frame):
 
         # which handle is currently being manipulated?
         if ("axis_a" in tags):
-            b_coords = self.canvas.coords(axis_b_id)
-            h_b_x, h_b_y = np.mean( b_coords[0::2] ),  np.mean( b_coords[1::2] )
-            new_coords = poly_oval( cx, cy, new_r, b, angle=new_angle)
+            e.a, e.angle = new_r, new_angle
+            new_coords = poly_oval( cx, cy, new_r, b, angle=new_angle, steps=oval_steps(new_r, b))  # fewer points while dragging
             h_b_x, h_b_y =  cx + b*np.sin(np.deg2rad(new_angle)),  cy + b*np.cos(np.deg2rad(new_angle))
             self.canvas.coords(axis_b_id, [ h_b_x-self.hr, h_b_y-self.hr, h_b_x+self.hr, h_b_y+self.hr] )
         elif ("axis_b" in tags):
-            a_coords = self.canvas.coords(axis_a_id)
-            h_a_x, h_a_y = np.mean( a_coords[0::2] ),  np.mean( a_coords[1::2] )
             new_angle = new_angle + 90   # a and b axes are offset by 90 degrees; angle is defined relative to a axis
-            new_coords = poly_oval( cx, cy, a, new_r, angle=new_angle)
+            e.b, e.angle = new_r, new_angle
+            new_coords = poly_oval( cx, cy, a, new_r, angle=new_angle, steps=oval_steps(a, new_r))
             h_a_x, h_a_y =  cx + a*np.cos(np.deg2rad(new_angle)),  cy - a*np.sin(np.deg2rad(new_angle))
             self.canvas.coords(axis_a_id, [ h_a_x-self.hr, h_a_y-self.hr, h_a_x+self.hr, h_a_y+self.hr] )
         else:
@@ -548,26 +739,21 @@ class EllipseEditor(tk.Frame):
         ringtext = self.canvas.itemcget(obj_id, 'text')
         result = askfloat("How many rings", "How many rings?", initialvalue=float(ringtext))
 
-        self.canvas.itemconfigure(obj_id,text=str(result))
+        if (result is not None) and (len(tags) > 0) and (tags[0] in self.ellipses):
+            self.canvas.itemconfigure(obj_id,text=str(result))
+            self.ellipses[tags[0]].rings = result
         self.canvas.focus_set()           # that dialog box stole the focus. get it back
         self.update_readout(None)
 
     def update_readout(self, event):
-        mains = self.canvas.find_withtag( "main" )
-        self.infostr = self.meta_file+'\n'+str(self.img_file)+'\n\n'
+        "Schedules a redraw of the readout, unless one is already on the way. So dragging doesn't redraw it on every event"
+        if self._readout_job is None:
+            self._readout_job = self.after(self.readout_ms, self.draw_readout)
 
-        new_df = pd.DataFrame(columns=self.df.columns)
-        # first we update the dataframe info
-        for main_id in mains:
-            tokentag = self.canvas.gettags( main_id )[0]
-            cx, cy, a, b, angle, rings, coords = self.retrieve_ellipse_info( tokentag )
-            a,b,angle = fix_abangle(a,b,angle)
-            [cx, cy, a, b, angle] = [int(round(x)) for x in [cx, cy, a, b, angle]]
-            #x, cy, a, b, angle = int(round(cx,0)), int(round(cy,0)), int(round(a,0), round(b,0), round(angle,0)
-            new_df = new_df.append({'cx':cx, 'cy':cy, 'a':a, 'b':b, 'angle':angle, 'rings':rings},ignore_index=True)
-
-        self.df = new_df
-        self.infostr += self.df.to_string(index=False,justify='left')      # then we output the dataframe info to a string
+    def draw_readout(self):
+        self._readout_job = None
+        self.infostr = self.meta_file+'\n'+str(self.img_file)+'\n\n'
+        self.infostr += ellipses_table([e.row() for e in self.ellipses.values()])
         self.canvas.itemconfigure(self.text, text=self.infostr)   # then we re-assign the text widget with the new string
 
 
@@ -578,6 +764,7 @@ def ellipse_editor(
     files:Param("Wildcard name for all CSV files to edit", str)='annotations/*.csv',
     imgbank:Param("Directory where all the (unlabeled) images are",str)='images/',
     tldir:Param("Directory where 'top losses' info is stored'",str)='top_losses/',
+    prefetch:Param("Number of files ahead & behind to read in the background",int)=8,
     ):
     global img_bank
     # typical command-line calling sequence:
@@ -605,5 +792,5 @@ def ellipse_editor(
 
     root = tk.Tk()
     root.title('espiownage: ellipse_editor')
-    EllipseEditor(root, meta_file_list, img_bank=img_bank, tldir=tldir, seq=seq).pack(fill="both", expand=True)
+    EllipseEditor(root, meta_file_list, img_bank=img_bank, tldir=tldir, seq=seq, prefetch=prefetch).pack(fill="both", expand=True)
     root.mainloop()
@@ -8,124 +8,155 @@ import numpy as np
 import cv2
 from PIL import Image
 import json
+import csv
+import sys
 from espiownage.core import *
-#from functools import partial
-#import multiprocessing as mp
+from functools import partial
 
-""" Generates bounding box info from our edited CSV files.  It outputs in two formats:
+""" Generates bounding box info from our edited CSV files.  It can output in these formats:
     1. .json: COCO(-TINY)-style bbox JSON file
     2. .csv: All the annotations in one big long CSV: see this notebook where we use this format:
         https://colab.research.google.com/drive/1bi8PYLFexoEcNKRClul0X3U6JRLKaH7M?usp=sharing
+    3. obpr .csv: Same, but with "one box per ring"
+    4. YOLO-style .txt files, one per image
+    Each annotation file is read & converted to bboxes only once (in parallel), and each of the
+    "emitters" below writes its format as the results come in.
 """
 
-def gen_coco_json(meta_file_list, bboxdir, step, reg, maxrings=11, allone=True):
-    """ sample file format is a dict like...
-    sample_coco_dict = {
-        "categories": [{"id": 62, "name": "chair"}, {"id": 63, "name": "couch"}, {"id": 72, "name": "tv"}, {"id": 75, "name": "remote"}, {"id": 84, "name": "book"}, {"id": 86, "name": "vase"}],
-        "images": [{"id": 542959, "file_name": "000000542959.jpg"}, {"id": 129739, "file_name": "000000129739.jpg"}],
-        "annotations": [{"image_id": 542959, "bbox": [32.52, 86.34, 8.53, 9.41], "category_id": 62}, {"image_id": 542959, "bbox": [98.12, 110.52, 1.95, 4.07], "category_id": 86}, {"image_id": 542959, "bbox": [91.28, 51.62, 3.95, 5.72], "category_id": 86}, {"image_id": 542959, "bbox": [110.48, 110.82, 14.55, 15.22], "category_id": 62}, {"image_id": 542959, "bbox": [96.63, 50.18, 18.67, 13.46], "category_id": 62}, {"image_id": 542959, "bbox": [0.69, 111.73, 11.8, 13.06], "category_id": 62}]
-    }"""
-    json_filename = bboxdir+'/coco_bboxes.json'
-    print(f"Generating COCO-style JSON file {json_filename} ...")
-    coco_dict = {}
+width, height = 512, 384  # image dims
+final_col_names = ['filename','width', 'height', 'label', 'xmin', 'ymin', 'xmax', 'ymax']
+
 
-    # categories
+def obpr_bboxes(this_df, all_rings):
+    """"One box per ring": for each antinode with rings > 0, concentric bboxes for ellipses scaled by
+    i/int(rings) for i = int(rings) down to 1. Done for all (antinode, ring) pairs at once.
+    Returns (N,4) array of bboxes, and how many zero-dim bboxes were left out"""
+    rings_int = np.where(all_rings > 0, np.trunc(all_rings), 0).astype(int)
+    row = np.repeat(np.arange(len(rings_int)), rings_int)          # which antinode each box is for
+    first = np.cumsum(rings_int) - rings_int                        # where each antinode's boxes start
+    i = rings_int[row] - (np.arange(len(row)) - first[row])          # counts down to 1 for each antinode
+    scale = i / rings_int[row]
+    [cx, cy, a, b, angle] = [this_df[c].values.astype(np.float64)[row] for c in ['cx', 'cy', 'a', 'b', 'angle']]
+    bboxes, valid = ellipse_to_bbox_batch(cx, cy, scale*a, scale*b, angle, coco=False)
+    return bboxes[valid], int((~valid).sum())
+
+
+def handle_one_file(meta_file, # the csv file to read
+    df,                     # ellipse data for this file, e.g. from annotation index. None = read the csv
+    obpr=False,             # also make "one box per ring" bboxes
+    maxrings=11,            # no ring counts should be above this
+    ):
+    "Reads one annotation file and makes all the kinds of bboxes we might write"
+    this_df = meta_to_df(meta_file) if df is None else normalize_ann_df(df)
+    all_rings = np.array([round(float(r),2) for r in this_df['rings']])
+    assert (all_rings <= maxrings).all()
+    has_rings = all_rings > 0
+    ellipses = [this_df[c].values[has_rings] for c in ['cx', 'cy', 'a', 'b', 'angle']]
+    bboxes, valid = ellipse_to_bbox_batch(*ellipses, coco=False)
+    coco_bboxes, _ = ellipse_to_bbox_batch(*ellipses, coco=True)
+    boxes = {'image': os.path.basename(str(meta_to_img_path(meta_file))),
+             'xyxy': bboxes[valid], 'rings': all_rings[has_rings][valid], 'rejected': int((~valid).sum()),
+             'coco': coco_bboxes, 'coco_rings': all_rings[has_rings]}
+    if obpr: boxes['obpr'], boxes['obpr_rejected'] = obpr_bboxes(this_df, all_rings)
+    return boxes
+
+
+def class_ids(rings, step, reg, allone):
+    "Category ids for COCO & YOLO, matching the categories from coco_categories"
+    if allone: return [0]*len(rings)
+    if reg: return [float(r) for r in rings]
+    return [max(0, ring_float_to_class_int(float(r), step=step)-1) for r in rings]  # id x is for (x+1)*step rings
+
+
+def coco_categories(step, reg, maxrings=11, allone=True):
     if allone:
         print("allone=True: Treating all objects as same class")
-        coco_dict["categories"] = [{"id": 0, "name": "AN"}]
+        return [{"id": 0, "name": "AN"}]
     elif reg:
         print('Regression model: 1 class, called "rings"')
-        coco_dict["categories"] = [{"id": 0, "name": "rings"}] # probably won't work
-    else:
-        coco_dict["categories"] = [{"id": x, "name":str((x+1)*step)} for x in range(int(round(maxrings/step)))]
-
-    # images
-    coco_dict["images"] = [{"id":i, "file_name":os.path.basename(str(meta_to_img_path(x)))} for i,x in enumerate(meta_file_list)]
-
-    # annotations
-    ann_list = []
-    for i, meta_file in enumerate(meta_file_list):
-        this_df = meta_to_df(meta_file)
-        image = os.path.basename(str(meta_to_img_path(meta_file)))
-        #print("meta_file = ",meta_file)
-        for index, row in this_df.iterrows():
-            [cx, cy, a, b, angle] = [x for x in [row['cx'], row['cy'], row['a'], row['b'], row['angle']]]
-            bbox = ellipse_to_bbox(cx, cy, a, b, angle, coco=True)
-            rings = round(float(row['rings']),2)
-            assert rings <= maxrings
-            if (rings > 0) and (bbox is not None):
-                if allone:
-                    category_id = 0
-                elif reg:
-                    category_id = rings
-                else:
-                    int(round(maxrings/step))
-                this_ann = {"image_id":image, "bbox": bbox, "category_id":category_id}
-                ann_list = ann_list + [this_ann]
-    coco_dict["annotations"] = ann_list
-
-    #print("coco_dict =\n",coco_dict)
-    with open(json_filename, 'w') as fp:
-        json.dump(coco_dict, fp)
-    return
-
-
-def gen_long_csv(
-    files_str,          # original string specifying meta / CSV files
-    meta_file_list,     # list of those files, with paths
-    bboxdir,            # where we're writing to
-    step,               # quantize ring counts via this bin size
-    reg,                # regression model?
-    obpr=False,         # "one box per ring" mode. every thing is an object "ring"
-    allone=True,        # all antinodes get marked as the same class: "AN" for antinode
-    maxrings=11,        # used for quantization.
-    quiet=True,        # don't list every name created
-    ):
-    out_csv_filename = bboxdir+'/annotations_obpr.csv' if obpr else bboxdir+'/annotations.csv'
-    if allone: print("allone=True: Treating all objects as same class")
-    print(f"Generating long CSV {out_csv_filename} ...")
-
-    width, height = 512, 384  # image dims
-    final_col_names = ['filename','width', 'height', 'label', 'xmin', 'ymin', 'xmax', 'ymax']
-
-    # Goal: make one big long list, turn it into a DataFrame, and then write it
-    ann_list = []
-    for i, meta_file in enumerate(meta_file_list):
-        if (not quiet): print("meta_file = ",meta_file, ", quiet = ",quiet)
-        this_df = meta_to_df(meta_file)
-        image_file = os.path.basename(str(meta_to_img_path(meta_file)))
-        this_df['filename'] = image_file
-
-        for index, row in this_df.iterrows(): #convert to bboxes
-            [cx, cy, a, b, angle] = [x for x in [row['cx'], row['cy'], row['a'], row['b'], row['angle']]]
-            rings = round(float(row['rings']),2)
-            assert rings <= maxrings
-            if rings > 0:
-                if not obpr:
-                    bbox = ellipse_to_bbox(cx, cy, a, b, angle, coco=False)
-                    if bbox is not None:
-                        if allone: label = 'AN'
-                        elif reg: label = rings
-                        else: label = ring_float_to_class_int(rings, step=step)
-                        line_list = [image_file, width, height, label, bbox[0], bbox[1], bbox[2], bbox[3]]
-                        ann_list.append(line_list)
-                else:                           # one box per ring (rounded as integers)
-                    rings_int, label = round(int(rings)), 'ring'
-                    line_list = []
-                    for i in range(rings_int,0,-1):  # counts down to 1, 0 is not included per Python norms
-                        _a, _b = (i/rings_int)*a, (i/rings_int)*b
-                        bbox = ellipse_to_bbox(cx, cy, _a, _b, angle, coco=False)
-                        if bbox is not None:
-                            line_list = ([image_file, width, height, label, bbox[0], bbox[1], bbox[2], bbox[3]])
-                            ann_list.append(line_list)
-
-
-
-    print("   Creating data frame")
-    new_df = pd.DataFrame(ann_list, columns=final_col_names)
-    new_df = new_df[final_col_names]  # just to force ordering
-    new_df.to_csv(out_csv_filename, index=False)
-    return
+        return [{"id": 0, "name": "rings"}] # probably won't work
+    return [{"id": x, "name":str((x+1)*step)} for x in range(int(round(maxrings/step)))]
+
+
+class LongCSVEmitter():
+    "All the annotations in one big long CSV, one row per bbox. obpr=True for the one-box-per-ring version"
+    def __init__(self, meta_file_list, bboxdir, step, reg, allone=True, obpr=False, maxrings=11):
+        self.step, self.reg, self.allone, self.obpr, self.rejected = step, reg, allone, obpr, 0
+        self.filename = bboxdir+'/annotations_obpr.csv' if obpr else bboxdir+'/annotations.csv'
+        if allone: print("allone=True: Treating all objects as same class")
+        print(f"Generating long CSV {self.filename} ...")
+        self.f = open(self.filename, 'w', newline='')
+        self.writer = csv.writer(self.f, lineterminator='\n')
+        self.writer.writerow(final_col_names)
+
+    def add(self, boxes):
+        image_file = boxes['image']
+        if self.obpr:
+            self.rejected += boxes['obpr_rejected']
+            self.writer.writerows([image_file, width, height, 'ring', *bbox] for bbox in boxes['obpr'].tolist())
+            return
+        self.rejected += boxes['rejected']
+        for bbox, rings in zip(boxes['xyxy'].tolist(), boxes['rings'].tolist()):
+            if self.allone: label = 'AN'
+            elif self.reg: label = rings
+            else: label = ring_float_to_class_int(rings, step=self.step)
+            self.writer.writerow([image_file, width, height, label, *bbox])
+
+    def close(self):
+        if self.rejected > 0: print(f"   Skipped {self.rejected} zero-dim bboxes")
+        self.f.close()
+
+
+class CocoJSONEmitter():
+    """COCO(-TINY)-style bbox JSON file. Sample file format is a dict like...
+    sample_coco_dict = {
+        "categories": [{"id": 62, "name": "chair"}, {"id": 63, "name": "couch"}, {"id": 72, "name": "tv"}, {"id": 75, "name": "remote"}, {"id": 84, "name": "book"}, {"id": 86, "name": "vase"}],
+        "images": [{"id": 542959, "file_name": "000000542959.jpg"}, {"id": 129739, "file_name": "000000129739.jpg"}],
+        "annotations": [{"image_id": 542959, "bbox": [32.52, 86.34, 8.53, 9.41], "category_id": 62}, {"image_id": 542959, "bbox": [98.12, 110.52, 1.95, 4.07], "category_id": 86}, {"image_id": 542959, "bbox": [91.28, 51.62, 3.95, 5.72], "category_id": 86}, {"image_id": 542959, "bbox": [110.48, 110.82, 14.55, 15.22], "category_id": 62}, {"image_id": 542959, "bbox": [96.63, 50.18, 18.67, 13.46], "category_id": 62}, {"image_id": 542959, "bbox": [0.69, 111.73, 11.8, 13.06], "category_id": 62}]
+    }
+    Annotations get streamed into the file as they come in, rather than building this whole dict first."""
+    def __init__(self, meta_file_list, bboxdir, step, reg, allone=True, obpr=False, maxrings=11):
+        self.step, self.reg, self.allone, self.first = step, reg, allone, True
+        self.filename = bboxdir+'/coco_bboxes.json'
+        print(f"Generating COCO-style JSON file {self.filename} ...")
+        categories = coco_categories(step, reg, maxrings=maxrings, allone=allone)
+        images = [{"id":i, "file_name":os.path.basename(str(meta_to_img_path(x)))} for i,x in enumerate(meta_file_list)]
+        self.f = open(self.filename, 'w')
+        self.f.write('{"categories": '+json.dumps(categories)+', "images": '+json.dumps(images)+', "annotations": [')
+
+    def add(self, boxes):
+        ids = class_ids(boxes['coco_rings'], self.step, self.reg, self.allone)
+        for bbox, category_id in zip(boxes['coco'].tolist(), ids):
+            self.f.write(('' if self.first else ', ') + json.dumps({"image_id":boxes['image'], "bbox": bbox, "category_id":category_id}))
+            self.first = False
+
+    def close(self):
+        self.f.write(']}')
+        self.f.close()
+
+
+class YoloEmitter():
+    "YOLO-style labels: for each image, a .txt file of 'class x_center y_center width height' lines, in units of image size"
+    def __init__(self, meta_file_list, bboxdir, step, reg, allone=True, obpr=False, maxrings=11):
+        self.step, self.reg, self.allone = step, reg, allone
+        self.yolodir = bboxdir+'/yolo'
+        print(f"Generating YOLO-style labels in {self.yolodir}/ ...")
+        mkdir_if_needed(self.yolodir)
+        with open(self.yolodir+'/classes.txt', 'w') as f:
+            f.write(''.join(c['name']+'\n' for c in coco_categories(step, reg, maxrings=maxrings, allone=allone)))
+
+    def add(self, boxes):
+        ids = [0]*len(boxes['rings']) if self.reg else class_ids(boxes['rings'], self.step, self.reg, self.allone)
+        xyxy = boxes['xyxy'].astype(float).reshape(-1, 4)
+        xc, yc = (xyxy[:,0] + xyxy[:,2])/2/width, (xyxy[:,1] + xyxy[:,3])/2/height
+        w, h = (xyxy[:,2] - xyxy[:,0])/width, (xyxy[:,3] - xyxy[:,1])/height
+        with open(self.yolodir+'/'+Path(boxes['image']).stem+'.txt', 'w') as f:
+            f.writelines(f"{c} {x:.6f} {y:.6f} {ww:.6f} {hh:.6f}\n" for c, x, y, ww, hh in zip(ids, xc, yc, w, h))
+
+    def close(self): return
+
+
+emitters = {'csv': LongCSVEmitter, 'obpr': partial(LongCSVEmitter, obpr=True), 'coco': CocoJSONEmitter, 'yolo': YoloEmitter}
 
 
 @call_parse
@@ -137,15 +168,27 @@ def gen_bboxes(
     files:Param("Wildcard name for all (ellipse) CSV files to read", str)='annotations/*.csv',
     bboxdir:Param("Directory to write bboxes to",str)='bboxes',
     step:Param("For classification model: Step size / resolution / precision of ring count",float)=1,
+    index:Param("Read annotations via this (auto-refreshed) annotation index file, e.g. ann_index.npz",str)='',
+    formats:Param("Comma-separated list of outputs from csv,obpr,coco,yolo. Default = csv (or obpr, with --obpr) & coco",str)='',
+    jobs:Param("Number of parallel processes to use. 0 = all CPU cores",int)=0,
     ):
 
     mkdir_if_needed(bboxdir)
 
     files = ''.join(files)  # convert to str
     meta_file_list = sorted(glob.glob(files)) # list of all annotation .csv files for ellipses
-
-
-    gen_long_csv(files, meta_file_list, bboxdir, step, reg, obpr=obpr, allone=(not notallone), quiet=(not notquiet))
-    gen_coco_json(meta_file_list, bboxdir, step, reg, allone=(not notallone))
-
+    dfs = split_ann_index(build_ann_index(files, index), meta_file_list) if index else [None]*len(meta_file_list)
+
+    formats = [f.strip() for f in formats.split(',')] if formats else ['obpr' if obpr else 'csv', 'coco']
+    outs = [emitters[f](meta_file_list, bboxdir, step, reg, allone=(not notallone)) for f in formats]
+
+    wrapper = partial(handle_one_file, obpr=('obpr' in formats))
+    n_errors = 0
+    for i, ok, boxes in parallel_imap(wrapper, list(zip(meta_file_list, dfs)), jobs=jobs, quiet=(not notquiet), desc='gen_bboxes: '):
+        if not ok:
+            n_errors += 1
+            continue
+        for out in outs: out.add(boxes)
+    for out in outs: out.close()
+    if n_errors > 0: sys.exit(1)
     return
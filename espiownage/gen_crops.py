@@ -9,46 +9,69 @@ import cv2
 from PIL import Image
 from espiownage.core import *
 from functools import partial
-import multiprocessing as mp
 import sys
+import io
+import tarfile
 
 """ Generates cropped images of individual antinodes using annotations
 """
 
-def handle_one_file(meta_file_list, # list of all the csv files
-    outdir,                # output directory, where to write mask files to
-    i,                      # index of which meta file we'll read from
-    height=512, width=384):  # image dimensions
-
-    meta_file = meta_file_list[i]
-    print(f"{i}/{len(meta_file_list)}: meta_file = {meta_file}",flush=True)
-
-    img_path = meta_to_img_path(meta_file)
-    img = Image.open(img_path)
+def make_crops(meta_file, # the csv file to make crops for
+    df,                     # ellipse data for this file, e.g. from annotation index. None = read the csv
+    height=512, width=384,  # image dimensions
+    img=None):              # the (PIL) image, if we already have it. None = read it
+    "Generator of (crop name, cropped PIL image, bbox, rings) for each antinode in one annotation file"
+    if img is None: img = Image.open(meta_to_img_path(meta_file))
 
     # read meta csv file for all rings
     col_names = ['cx', 'cy', 'a', 'b', 'angle', 'rings']
-    df = pd.read_csv(meta_file, header=None, names=col_names)
-    df.drop_duplicates(inplace=True)  # sometimes the data from Zooniverse has duplicate rows
-    for index, row in df.iterrows() :
-        [cx, cy, a, b, angle] = [int(round(x)) for x in [row['cx'], row['cy'], row['a'], row['b'], row['angle']]]
-        rings = round(float(row['rings']),2)
-        a, b, angle = fix_abangle(a,b,angle)
-        if (rings > 0):
-            bb = ellipse_to_bbox(cx, cy, a, b, angle)
-            if bb is not None:
-                img_cropped = crop_to_bbox(img, bb)
-                if img_cropped is not None:
-                    out_file = outdir+'/'+str(Path(meta_file).stem)+f"_{bb[0]}_{bb[1]}_{bb[2]}_{bb[3]}_{rings}.png"
-                    img_cropped.save(out_file)
+    if df is None: df = pd.read_csv(meta_file, header=None, names=col_names)
+    bboxes, all_rings, n_skipped = ann_df_to_crop_bboxes(df)
+    if n_skipped > 0: print(f"{meta_file}: skipping {n_skipped} zero-dim bboxes")
+    for bb, rings in zip(bboxes, all_rings):
+        img_cropped = crop_to_bbox(img, bb)
+        if img_cropped is not None:
+            yield str(Path(meta_file).stem)+f"_{bb[0]}_{bb[1]}_{bb[2]}_{bb[3]}_{rings}.png", img_cropped, bb, rings
+
+
+def handle_one_file(meta_file, # the csv file to make crops for
+    df,                     # ellipse data for this file, e.g. from annotation index. None = read the csv
+    outdir,                 # output directory, where to write cropped images to
+    height=512, width=384):  # image dimensions
+    for name, img_cropped, bb, rings in make_crops(meta_file, df, height=height, width=width):
+        img_cropped.save(outdir+'/'+name)
     return
 
 
+def write_one_shard(shard_path, # tar file to write
+    file_dfs,               # list of (meta_file, df) whose crops go in this shard
+    height=512, width=384):  # image dimensions
+    "Writes crops from several annotation files as PNGs in one tar file. Returns index rows for them"
+    rows = []
+    with tarfile.open(shard_path, 'w') as tar:
+        for meta_file, df in file_dfs:
+            mtime = int(os.path.getmtime(meta_file))   # not the time now, so the same data always gives the same shard
+            for name, img_cropped, bb, rings in make_crops(meta_file, df, height=height, width=width):
+                buf = io.BytesIO()
+                img_cropped.save(buf, format='png')
+                info = tarfile.TarInfo(name)
+                info.size, info.mtime = buf.tell(), mtime
+                buf.seek(0)
+                tar.addfile(info, buf)
+                rows.append([name, Path(meta_file).stem] + [int(x) for x in bb] + [float(rings)])
+    with tarfile.open(shard_path, 'r') as tar:   # only reads the headers; gets us where each PNG starts
+        offsets = {m.name: (m.offset_data, m.size) for m in tar.getmembers()}
+    shard = Path(shard_path).name
+    return [[shard, *offsets[r[0]]] + r for r in rows]
+
 
 @call_parse
 def gen_crops(
     files:Param("Wildcard name for all CSV files to edit", str)='annotations/*.csv',
     outdir:Param("Directory to write output cropped images to",str)='crops/',
+    index:Param("Read annotations via this (auto-refreshed) annotation index file, e.g. ann_index.npz",str)='',
+    jobs:Param("Number of parallel processes to use. 0 = all CPU cores",int)=0,
+    shard:Param("Pack crops into tar files of this many annotation files each, plus crops_index.csv. 0 = separate PNGs",int)=0,
     ):
     "Generate cropped images for all annotations"
 
@@ -56,17 +79,23 @@ def gen_crops(
 
     files = ''.join(files)
     meta_file_list = sorted(glob.glob(files))
+    dfs = split_ann_index(build_ann_index(files, index), meta_file_list) if index else [None]*len(meta_file_list)
+
+    if shard <= 0:
+        wrapper = partial(handle_one_file, outdir=outdir)
+        results, errors = parallel_map(wrapper, list(zip(meta_file_list, dfs)), jobs=jobs, desc='gen_crops: ')
+        if len(errors) > 0: sys.exit(1)
+        return
 
-    parallel = True  # not too slow sequential but parallel=True is good
-    if not parallel:
-        for i in range(len(meta_file_list)):
-            handle_one_file(meta_file_list, outdir, i)
-    else:
-        # parallel processing
-        wrapper = partial(handle_one_file, meta_file_list, outdir)
-        pool = mp.Pool(mp.cpu_count())
-        results = pool.map(wrapper, range(len(meta_file_list)))
-        pool.close()
-        pool.join()
+    # each worker writes one whole shard, so shard files are written sequentially & no crops pass through the parent
+    file_dfs = list(zip(meta_file_list, dfs))
+    items = [(outdir.rstrip('/')+f'/crops_{k:05d}.tar', file_dfs[start:start+shard])
+             for k, start in enumerate(range(0, len(file_dfs), shard))]
+    results, errors = parallel_map(write_one_shard, items, jobs=jobs, desc='gen_crops: ')
+    rows = [row for result in results if result is not None for row in result]
+    index_df = pd.DataFrame(rows, columns=crop_index_cols)
+    index_df.to_csv(outdir.rstrip('/')+'/crops_index.csv', index=False)
+    print(f"gen_crops: {len(index_df)} crops in {len(items)} shards")
+    if len(errors) > 0: sys.exit(1)
 
     return
@@ -14,17 +14,25 @@
 from fastcore.script import *
 
 import numpy as np
+import pandas as pd
 import cv2
 import random
 import os
 import time
 from functools import partial
-import multiprocessing as mp
 from espiownage.core import *
+# under private names, so that "from espiownage.gen_fake import *" doesn't hide the gen_masks etc. CLI functions
+import espiownage.gen_masks as _gen_masks
+import espiownage.gen_bboxes as _gen_bboxes
+import espiownage.gen_crops as _gen_crops
+from PIL import Image
 
 import sys, traceback
 from shutil import get_terminal_size
 import glob
+import json
+import itertools
+import multiprocessing as mp
 
 winName = 'ImgWindowName'
 imWidth = 512
@@ -46,49 +54,50 @@ min_line_width = 4  # number of pixels per each ring (dark-light pair)
 
 pad = "       "
 
-def bandpass_mixup(img_fake, path_real=os.path.expanduser('~/datasets/espiownage-data/images/')):
-    '''
-    For more realistic-looking images (still not as good as StyleGAN),
-    replace low & high frequency components ('background')
-    of fake images using those components from real images
-    '''
-
-    # get a random background from the group of 'true' images
-    file_true = random.choice(glob.glob(path_real+'/*.png'))
-    img_true = cv2.imread(file_true, cv2.IMREAD_GRAYSCALE)
-    # maybe flip the image
-    flipchoice = np.random.choice([-1,0,1,2])
-    if (flipchoice != 2):
-        img_true = cv2.flip(img_true, flipchoice)
-
-    # take fourier transforms of fake and true images
-    dft_true = cv2.dft(np.float32(img_true),flags = cv2.DFT_COMPLEX_OUTPUT)
-    dft_shift_true = np.fft.fftshift(dft_true)    # center the "dc" part of image
-
-    dft_fake = cv2.dft(np.float32(img_fake),flags = cv2.DFT_COMPLEX_OUTPUT)
-    dft_shift_fake = np.fft.fftshift(dft_fake)    # center the "dc" part of image
-
-    # Set up a filter: Keep the Lows and the Highs
-    # create a rectagular mask first, center square is 1, remaining all zeros. LPF
-    rows, cols = img_fake.shape
-    crow,ccol = rows//2 , cols//2
-    wl, wh = 8, 0     #  width for LPF and HPF respectively
-    mask = np.zeros((rows,cols,2),np.uint8)
-    mask[crow-wl:crow+wl, ccol-wl:ccol+wl] = 1   # LPF
-    if wh > 0:
-        mask[0:wh,:] = 1    # HPF
-        mask[-wh:,:] = 1    # HPF
-        mask[:,0:wh] = 1    # HPF
-        mask[:,-wh:] = 1    # HPF
-    fshift = np.random.rand()*3*dft_shift_true*mask + (1-mask)*dft_shift_fake   # L/H from true, mids from fake
-
-    # inverse DFT
-    f_ishift = np.fft.ifftshift(fshift)
-    img_back = cv2.idft(f_ishift)
-    img_back = cv2.magnitude(img_back[:,:,0],img_back[:,:,1])
-    cv2.normalize(img_back, img_back, 0, 255, cv2.NORM_MINMAX)
-
-    return np.clip(img_back, 0, 255)
+lowpass_width = 8      # half-width of the square of low frequencies that FakeBatcher takes from real images
+spectrum_bank = None   # low-freq. spectra of real images, shape (n_images, 4 flips, 2*lowpass_width, 2*lowpass_width, 2)
+
+
+def lowfreq_spectrum(img, wl=lowpass_width):
+    "Centered (fftshifted) DFT of img, cut down to the central (2*wl, 2*wl) square of low frequencies"
+    dft_shift = np.fft.fftshift(cv2.dft(np.float32(img),flags = cv2.DFT_COMPLEX_OUTPUT))
+    crow, ccol = img.shape[0]//2, img.shape[1]//2
+    return dft_shift[crow-wl:crow+wl, ccol-wl:ccol+wl]
+
+
+def get_spectrum_bank(path_real=os.path.expanduser('~/datasets/espiownage-data/images/'),
+    bank_file=None):   # .npy file to keep the bank in between runs (memory-mapped, so worker processes share one copy). None = don't save it
+    """Low-frequency spectra of all the real images (and their flips), for background replacement.
+    Made once per process, or with bank_file, once until the real images change"""
+    global spectrum_bank
+    if spectrum_bank is not None: return spectrum_bank
+    files = sorted(glob.glob(path_real+'/*.png'))
+    sources = [[os.path.basename(f), os.path.getsize(f), os.path.getmtime(f)] for f in files]   # what went into the bank
+    list_file = None if bank_file is None else os.path.splitext(bank_file)[0]+'.json'
+    if list_file and os.path.exists(bank_file) and os.path.exists(list_file):
+        with open(list_file) as f:
+            if json.load(f) == sources:
+                spectrum_bank = np.load(bank_file, mmap_mode='r')
+                return spectrum_bank
+
+    print(f"gen_fake: making low-frequency spectrum bank from {len(files)} real images")
+    wl = lowpass_width
+    tmp_file = None if bank_file is None else os.path.splitext(bank_file)[0]+'.tmp.npy'
+    shape = (len(files), 4, 2*wl, 2*wl, 2)
+    bank = np.empty(shape, np.float32) if bank_file is None else np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=shape)
+    for i, f in enumerate(files):
+        img_true = cv2.imread(f, cv2.IMREAD_GRAYSCALE)
+        for j, flipchoice in enumerate([-1,0,1,2]):     # 2 = don't flip
+            bank[i, j] = lowfreq_spectrum(img_true if flipchoice == 2 else cv2.flip(img_true, flipchoice))
+    if bank_file is None:
+        spectrum_bank = bank
+        return spectrum_bank
+    bank.flush()
+    del bank
+    os.replace(tmp_file, bank_file)
+    with open(list_file, 'w') as f: json.dump(sources, f)
+    spectrum_bank = np.load(bank_file, mmap_mode='r')
+    return spectrum_bank
 
 
 def blur_image(img, kernel_size=7):
@@ -101,7 +110,6 @@ def blur_image(img, kernel_size=7):
 
 def draw_waves(img):  # TODO make intensity vary smoothly
     xs = np.arange(0, imWidth)
-    ys = np.arange(0, imHeight)
 
     amp = random.randint(10,200)
     x_wavelength = random.randint(100,int(imWidth/2))
@@ -110,14 +118,12 @@ def draw_waves(img):  # TODO make intensity vary smoothly
     y_spacing = random.randint(thickness + thickness*int(np.abs(1.5*slope)), int(imHeight/3))
     numlines = 60+int(imHeight/y_spacing)
 
-    for j in range(numlines):   # skips y_spacing in between drawings
-        y_start = j*y_spacing - img.shape[1]*abs(slope)
-        pts = []
-        for i in range(len(xs)):
-            pt = [ int(xs[i]), int(y_start + slope*xs[i]+ amp * np.cos(xs[i]/x_wavelength))]
-            pts.append(pt)
-        pts = np.array(pts, np.int32)
-        cv2.polylines(img, [pts], False, black, thickness=thickness)
+    # all lines at once: (numlines, imWidth) array of y values. Each line is the same wave, shifted by y_spacing
+    y_starts = np.arange(numlines)*y_spacing - img.shape[1]*abs(slope)
+    ys = y_starts[:,None] + slope*xs[None,:] + amp*np.cos(xs/x_wavelength)[None,:]
+    pts = np.empty((numlines, len(xs), 2), np.int32)
+    pts[:,:,0], pts[:,:,1] = xs, ys    # int32 conversion truncates, same as int()
+    cv2.polylines(img, list(pts), False, black, thickness=thickness)
     return
 
 
@@ -127,7 +133,7 @@ def get_ellipse_box(center, axes, angle):  # converts ellipse to bounding box
 
 
 
-def draw_rings(img,center,axes,angle=45,num_rings=5.5):  # TODO make intensity vary smoothly
+def draw_rings_ellipses(img,center,axes,angle=45,num_rings=5.5):  # the old way: one cv2 ellipse per ring
     num_drawrings, thickness = max(axes), 1
     if num_rings < 0.2: num_rings = 0.2+0.2*np.random.rand()
     phase = 2*np.pi*np.random.rand()
@@ -139,6 +145,41 @@ def draw_rings(img,center,axes,angle=45,num_rings=5.5):  # TODO make intensity v
     return ellipse   # returns outermost ellipse
 
 
+def draw_rings_analytic(img,center,axes,angle=45,num_rings=5.5):
+    """Same rings as draw_rings_ellipses, but with intensity varying smoothly, all computed at once:
+    the 'ring number' of each pixel comes from its normalized elliptical radius"""
+    num_drawrings = max(axes)
+    if num_rings < 0.2: num_rings = 0.2+0.2*np.random.rand()
+    phase = 2*np.pi*np.random.rand()
+    minc, maxc = random.randint(0,60), random.randint(150,250)
+
+    rmax = num_drawrings/(num_drawrings+1)   # the outermost ring
+    xmin, ymin, xmax, ymax = ellipse_to_bbox(center[0], center[1], rmax*axes[0]+1, rmax*axes[1]+1, angle, nozero=False)
+    xmax, ymax = min(xmax+1, img.shape[1]), min(ymax+1, img.shape[0])
+    xs = np.arange(xmin, xmax, dtype=np.float32)[None,:] - center[0]
+    ys = np.arange(ymin, ymax, dtype=np.float32)[:,None] - center[1]
+    theta = np.radians(-angle)             # same orientation convention as draw_ellipse
+    cos, sin, a, b = np.cos(theta), np.sin(theta), axes[0], axes[1]
+    # normalized elliptical radius, rho = 1 on the ellipse given by axes. rho**2 is a quadratic form in x & y
+    rho = np.float32((cos/a)**2 + (sin/b)**2)*xs*xs + np.float32(2*cos*sin*(1/a**2 - 1/b**2))*xs*ys \
+        + np.float32((sin/a)**2 + (cos/b)**2)*ys*ys
+    np.sqrt(rho, out=rho)
+    inside = rho <= rmax
+    # j = rho*(num_drawrings+1) - 1 is the continuous version of the ring index in draw_rings_ellipses
+    k = 2*np.pi*num_rings/num_drawrings
+    color = np.sin(np.float32(k*(num_drawrings+1))*rho + np.float32(phase - k), out=rho)
+    color = np.clip(np.rint(minc + (maxc-minc)*color), 0, 255).astype(np.uint8)
+    region = (img[:,:,0] if img.ndim == 3 else img)[ymin:ymax, xmin:xmax]
+    np.copyto(region, color, where=inside)
+    return img
+
+
+ring_drawers = {'analytic': draw_rings_analytic, 'ellipses': draw_rings_ellipses}
+
+def draw_rings(img,center,axes,angle=45,num_rings=5.5,method='analytic'):
+    return ring_drawers[method](img, center, axes, angle=angle, num_rings=num_rings)
+
+
 
 
 def does_overlap( a, b):
@@ -161,15 +202,12 @@ def does_overlap_previous(box, boxes_arr):
 
 
 
-def draw_antinodes(img,num_antinodes=1):
-    boxes_arr = []
-    caption = ""
-
-    if (num_antinodes==0):
-        caption = "{0},{1},{2},{3},{4},{5}".format( 0,  0,    0,  0,    0,   0.0)  # as per @achmorrison's format
-
-    for an in range(num_antinodes): # draw a bunch of antinodes
+class RejectionPlacer():
+    "The old way to place antinodes: random sizes & positions, re-drawn (up to 2000 times) until they don't overlap"
+    def __init__(self): self.boxes_arr, self.n_failed = [], 0
 
+    def place(self, an):
+        "Returns (center, axes, angle, num_rings) for antinode number an, or None if it doesn't fit"
         axes = (random.randint(15,int(imWidth/3.5)), random.randint(15,int(imHeight/3.5)))   # semimajor and semiminor axes of ellipse
         axes = sorted(axes, reverse=True)   # do descending order, for definiteness. i.e. so a > b
 
@@ -190,7 +228,7 @@ def draw_antinodes(img,num_antinodes=1):
         # make sure they don't overlap, and are in bounds of image
         # TODO: the following random placement is painfully inefficient
         trycount, maxtries = 0, 2000
-        while (   ( (True == does_overlap_previous(box, boxes_arr))
+        while (   ( (True == does_overlap_previous(box, self.boxes_arr))
             or (box[0]<0) or (box[2] > imWidth)
             or (box[1]<0) or (box[3] > imHeight)  ) and (trycount < maxtries) ):
             trycount += 1
@@ -206,81 +244,378 @@ def draw_antinodes(img,num_antinodes=1):
             angle = random.randint(1, 180)
             box = get_ellipse_box(center, axes, angle)
 
+        if (trycount >= maxtries):
+            self.n_failed += 1
+            return None
+        self.boxes_arr.append(box)
+        return center, axes, angle, num_rings
+
+
+class GridPlacer():
+    """Places antinodes with sizes all drawn from RejectionPlacer's first-try distribution. For the first quicktries
+    sizes it tries one random center each (a quick check of the occupancy grid); after that it picks each new size's
+    center from among all the places where its bbox would fit, using the occupancy grid's integral image, which
+    is made at most once per antinode. If none of maxtries more sizes fit anywhere, the antinode is skipped &
+    counted in n_failed"""
+    def __init__(self, maxtries=10, quicktries=50):
+        self.occupied = np.zeros((imHeight+1, imWidth+1), np.uint8)   # +1: bboxes are clipped at imWidth, imHeight
+        self.maxtries, self.quicktries = maxtries, quicktries
+        self.S, self.n_failed = None, 0   # S: integral image of occupied, made when needed & kept until occupied changes
+
+    def free_center(self, axes, angle, search=True):
+        """Random center for which the ellipse's bbox won't overlap any earlier ones, or None if there's no room.
+        If not search, just tries one random center"""
+        cxs, cys = np.arange(axes[0], imWidth-axes[0]+1), np.arange(axes[1], imHeight-axes[1]+1)  # same ranges as before
+        if len(cxs) == 0 or len(cys) == 0: return None
+        rad = np.radians(angle)
+        a2, b2, cos2, sin2 = [x**2 for x in [axes[0], axes[1], np.cos(rad), np.sin(rad)]]  # as in ellipse_to_bbox
+        delta_x, delta_y = np.sqrt(a2*cos2 + b2*sin2), np.sqrt(a2*sin2 + b2*cos2)
+        # bbox for center (cx,cy) covers cx-left..cx+right & cy-up..cy+down (inclusive, clipped at image edges)
+        left, right, up, down = int(np.ceil(delta_x)), int(delta_x), int(np.ceil(delta_y)), int(delta_y)
+        if not search:
+            cx, cy = random.randint(cxs[0], cxs[-1]), random.randint(cys[0], cys[-1])
+            return None if self.occupied[max(cy-up,0):cy+down+1, max(cx-left,0):cx+right+1].any() else (cx, cy)
+        if self.S is None: self.S = cv2.integral(self.occupied)    # S[y,x] = number of taken pixels above & left of (x,y)
+        y0, y1 = np.clip(cys-up, 0, imHeight), np.clip(cys+down, 0, imHeight)+1
+        x0, x1 = np.clip(cxs-left, 0, imWidth), np.clip(cxs+right, 0, imWidth)+1
+        if (x0[0] == cxs[0]-left) and (x1[-1] == cxs[-1]+right+1):   # usual case: x needn't be clipped, so slices will do
+            x0, x1 = slice(x0[0], x0[-1]+1), slice(x1[0], x1[-1]+1)
+        S0, S1 = self.S[y0], self.S[y1]
+        taken = S1[:,x1] - S0[:,x1] - S1[:,x0] + S0[:,x0]   # number of taken pixels in each possible bbox
+        free = np.flatnonzero(taken == 0)
+        if len(free) == 0: return None
+        k = free[random.randrange(len(free))]
+        return (int(cxs[k % len(cxs)]), int(cys[k // len(cxs)]))
+
+    def place(self, an):
+        "Returns (center, axes, angle, num_rings) for antinode number an, or None if it doesn't fit"
+        num_rings = np.random.uniform(low=0.5,high=11.0)            # well say that an antinode has at least 1 ring
+        for trycount in range(self.quicktries + self.maxtries):
+            axes = (random.randint(15,int(imWidth/3.5)), random.randint(15,int(imHeight/3.5)))   # as RejectionPlacer's first try
+            axes = sorted(axes, reverse=True)   # do descending order, for definiteness. i.e. so a > b
+            angle = random.randint(1, 179)       # ellipses are symmetric after 180 degree rotation
+            center = self.free_center(axes, angle, search=(trycount >= self.quicktries))
+            if center is not None:
+                if (axes[1]/num_rings < min_line_width):     # make sure line width isn't too small to be resolved
+                    num_rings = axes[1] / min_line_width
+                box = get_ellipse_box(center, axes, angle)
+                self.occupied[box[1]:box[3]+1, box[0]:box[2]+1] = 1
+                self.S = None
+                return center, axes, angle, num_rings
+        self.n_failed += 1
+        return None
+
+
+placers = {'grid': GridPlacer, 'rejection': RejectionPlacer}
+
+
+def draw_antinodes(img,num_antinodes=1,ring_method='analytic',placement='rejection'):
+    "Draws num_antinodes antinodes on img. Ones that don't fit are skipped (placement_stats counts how often)"
+    placer = placers[placement]()
+    caption = ""
+
+    if (num_antinodes==0):
+        caption = "{0},{1},{2},{3},{4},{5}".format( 0,  0,    0,  0,    0,   0.0)  # as per @achmorrison's format
+
+    for an in range(num_antinodes): # draw a bunch of antinodes
+        placed = placer.place(an)
         success = False
-        if (trycount < maxtries):
-            draw_rings(img, center, axes, angle=angle, num_rings=num_rings)
+        if placed is not None:
+            center, axes, angle, num_rings = placed
+            draw_rings(img, center, axes, angle=angle, num_rings=num_rings, method=ring_method)
             this_caption = "{0},{1},{2},{3},{4},{5}".format(center[0], center[1],axes[0], axes[1], angle, round(num_rings,1))
             if '0,0,0,0' not in this_caption: success = True
         else:   # just skip this antinode
-            print("\n\r",pad,":WARNING Can't fit an=",an,"\n",sep="",end="\r")
             this_caption = ""
 
         if (success):               # don't add blank lines, only add lines for success
             if (an > 0):
                 caption+="\n"
             caption += this_caption
-            boxes_arr.append(box)
     return img, caption
 
 
-
-def handle_one_file(outdir, framenum):
-    print("framenum = ",framenum)
-
-    np_dims = (imHeight, imWidth, 1)     # for numpy, image dimensions are reversed
-    img = 128*np.ones(np_dims, np.uint8)
-
-    draw_waves(img)   # this is the main bottleneck, execution-time-wise
-
-    max_antinodes = 6
-    num_antinodes= random.randint(1,max_antinodes)
-    img, caption = draw_antinodes(img, num_antinodes=num_antinodes)
-
-    if (np.random.random() <= blur_prob): # blur image a bit
-        blur_ksize = random.choice([3,5])
-        img = blur_image(img, kernel_size=blur_ksize)
-
-    # post-blur noise
-    noise = cv2.randn(np.zeros(np_dims, np.uint8),40,40); # normal dist, mean 40 std 40
-    img = cv2.add(img, noise)
-
-
-    # further degrade image: drop some pixels
-    mask = np.random.choice([0,1],size=img.shape).astype(np.float32)
-    img = img*mask
-
-    # finally replace background using real data
-    img = bandpass_mixup(img)
-
-    prefix = 'steelpan_'+str(framenum).zfill(7)
-    cv2.imwrite(outdir+'/images/'+prefix+'.png',img)
-    with open(outdir+'/annotations/'+prefix+meta_extension, "w") as text_file:
-        text_file.write(caption+'\n')
-    return
+def placement_stats(placement='rejection', n_frames=1000, max_antinodes=6):
+    "Places (but doesn't draw) antinodes for n_frames frames. Returns DataFrame of them all, and number that didn't fit"
+    rows, n_failed = [], 0
+    for frame in range(n_frames):
+        placer = placers[placement]()
+        for an in range(random.randint(1,max_antinodes)):
+            placed = placer.place(an)
+            if placed is not None: rows.append([frame, *placed[0], *placed[1], placed[2], placed[3]])
+        n_failed += placer.n_failed
+    return pd.DataFrame(rows, columns=['frame', 'cx', 'cy', 'a', 'b', 'angle', 'rings']), n_failed
+
+
+def seed_frame(seed, framenum):
+    "Seeds all the RNGs we use from (seed, framenum) alone, so frame k comes out the same whichever process makes it"
+    state = np.random.SeedSequence([seed, framenum]).generate_state(9)   # independent streams for each frame
+    random.seed(int.from_bytes(state[:4].tobytes(), 'little'))
+    np.random.seed(state[4:8])
+    cv2.setRNGSeed(int(state[8] & 0x7fffffff))   # for cv2.randn
+
+
+def frame_prefix(framenum): return 'steelpan_'+str(framenum).zfill(7)
+
+
+class FakeBatcher():
+    """Makes fake images a batch at a time, in one (B,H,W) buffer. Waves & antinodes get drawn one image at a time
+    (each frame makes all its random draws from its own seed, as before), but then blur, noise, pixel dropout and
+    background replacement are done for the whole batch at once, in scratch buffers that get reused.
+    Background replacement only changes the lowest (2*lowpass_width)**2 frequencies, so instead of a full DFT round-trip
+    it's done with small matrix products: out = img + (inverse DFT of the change in those frequencies)"""
+    def __init__(self, batch_size=16):
+        H, W, wl = imHeight, imWidth, lowpass_width
+        self.batch_size = 0
+        self.resize(batch_size)
+        f = np.arange(-wl, wl)   # frequencies in the central square of the fftshifted spectrum
+        ty, tx = 2*np.pi*np.outer(f, np.arange(H))/H, 2*np.pi*np.outer(f, np.arange(W))/W
+        self.fwd_y = np.float32(np.concatenate([np.cos(ty), np.sin(ty)]))       # (2*2wl, H): real & -imag parts of DFT rows
+        self.fwd_x = np.complex64(np.exp(-1j*tx).T)                             # (W, 2wl)
+        self.inv_x = np.complex64(np.exp(1j*tx))/(H*W)                          # (2wl, W), includes the 1/(H*W) of the inverse
+        cy, sy = np.cos(ty).T, np.sin(ty).T
+        self.inv_y = np.float32(np.block([[cy, -sy], [sy, cy]]))                # (2H, 2*2wl): real & imag parts of inverse
+
+    def resize(self, batch_size):
+        "Makes sure the scratch buffers can hold batch_size images"
+        if batch_size <= self.batch_size: return
+        B, H, W, wl = batch_size, imHeight, imWidth, lowpass_width
+        self.batch_size = B
+        self.imgs, self.noise, self.keep = [np.empty((B, H, W), np.uint8) for i in range(3)]
+        self.fimgs = np.empty((B, H, W), np.float32)
+        self.lows = np.empty((B, 2*2*wl, W), np.float32)
+        self.inv = np.empty((B, 2*H, W), np.float32)
+        self.mix = np.empty((B, 2*wl, 2*wl), np.complex64)
+
+    def __call__(self, framenums, ring_method='analytic', placement='rejection', seed=1):
+        """Makes fake images for framenums. Returns (B,H,W) uint8 array and list of B captions.
+        The array is a view of the batch buffer, so it gets overwritten by the next call"""
+        B, H, W = len(framenums), imHeight, imWidth
+        self.resize(B)
+        imgs, noise, keep, fimgs = self.imgs[:B], self.noise[:B], self.keep[:B], self.fimgs[:B]
+        bank = get_spectrum_bank()
+        imgs[:] = 128
+        captions, blur_ksizes = [], []
+        for i, framenum in enumerate(framenums):   # same random draws, in the same order, as for one image at a time
+            seed_frame(seed, framenum)
+            draw_waves(imgs[i])
+            max_antinodes = 6
+            num_antinodes= random.randint(1,max_antinodes)
+            captions.append(draw_antinodes(imgs[i], num_antinodes=num_antinodes, ring_method=ring_method, placement=placement)[1])
+            blur_ksizes.append(random.choice([3,5]) if (np.random.random() <= blur_prob) else 0)
+            cv2.randn(noise[i],40,40)     # normal dist, mean 40 std 40
+            keep[i] = np.random.randint(0, 2, size=(H, W), dtype=np.int32)   # same draws as np.random.choice([0,1])
+            i_true = random.choice(range(len(bank)))   # background from a random real image, maybe flipped
+            flipchoice = np.random.choice([-1,0,1,2])
+            low = np.random.rand()*3*bank[i_true, flipchoice+1]
+            self.mix[i] = low[...,1] + 1j*low[...,0]   # fftshift of cv2.dft output also swapped its (real, imag) channels
+
+        for i, k in enumerate(blur_ksizes):   # blur some images a bit
+            if k > 0: cv2.GaussianBlur(imgs[i], (k,k), 0, dst=imgs[i])
+        cv2.add(imgs.reshape(-1, W), noise.reshape(-1, W), dst=imgs.reshape(-1, W))   # post-blur noise (saturating)
+        np.multiply(imgs, keep, out=fimgs)    # further degrade image: drop some pixels
+
+        # finally replace background using real data: swap in the low frequencies, i.e. add (new - old lows)
+        lows, inv, mix = self.lows[:B], self.inv[:B], self.mix[:B]
+        np.matmul(self.fwd_y, fimgs, out=lows)
+        mix -= (lows[:, :2*lowpass_width] - 1j*lows[:, 2*lowpass_width:]) @ self.fwd_x
+        p = mix @ self.inv_x
+        lows[:, :2*lowpass_width], lows[:, 2*lowpass_width:] = p.real, p.imag
+        np.matmul(self.inv_y, lows, out=inv)
+        re, im = inv[:, :H], inv[:, H:]
+        re += fimgs
+        np.multiply(re, re, out=re)
+        np.multiply(im, im, out=im)
+        np.sqrt(re + im, out=fimgs)           # magnitude
+        lo, hi = fimgs.min(axis=(1,2), keepdims=True), fimgs.max(axis=(1,2), keepdims=True)   # normalize each to 0..255
+        fimgs -= lo
+        fimgs *= np.where(hi > lo, 255/np.maximum(hi - lo, np.finfo(np.float32).tiny), 0)
+        np.rint(fimgs, out=fimgs)
+        np.clip(fimgs, 0, 255, out=fimgs)
+        imgs[:] = fimgs                       # same rounding as cv2.imwrite
+        return imgs, captions
+
+
+batcher = None   # FakeBatcher for this process, made when first needed
+
+def make_fake_batch(framenums, ring_method='analytic', placement='rejection', seed=1):
+    "Makes fake images for framenums. Returns (B,H,W) uint8 array (overwritten by the next call) and list of B captions"
+    global batcher
+    if batcher is None: batcher = FakeBatcher(len(framenums))
+    return batcher(framenums, ring_method=ring_method, placement=placement, seed=seed)
+
+
+def make_fake_image(framenum, ring_method='analytic', placement='rejection', seed=1):
+    "Makes fake image number framenum. Returns it as a uint8 array, and its caption (CSV text of the ellipses)"
+    imgs, captions = make_fake_batch([framenum], ring_method=ring_method, placement=placement, seed=seed)
+    return imgs[0].copy(), captions[0]
+
+
+def caption_to_ellipses(caption, dtype=np.float32):
+    "(N,6) array of cx, cy, a, b, angle, rings from a caption"
+    return np.array([[float(x) for x in line.split(',')] for line in caption.split('\n') if line], dtype).reshape(-1, 6)
+
+
+def handle_one_file(outdir, framenum,
+    done=False,    # frame was made already: just read its annotations (to redo its masks & bboxes)
+    ring_method='analytic', placement='rejection', seed=1,
+    extras=(),     # also make any of 'masks', 'bboxes', 'crops' for this frame, the same way gen_masks etc. would
+    step=1,        # ring count step size for mask classes
+    img=None, caption=None):   # the frame, if it's been made already (e.g. by make_fake_batch)
+    prefix = frame_prefix(framenum)
+    meta_file = outdir+'/annotations/'+prefix+meta_extension
+    if done:
+        with open(meta_file) as text_file: caption = text_file.read()
+    else:
+        if img is None: img, caption = make_fake_image(framenum, ring_method=ring_method, placement=placement, seed=seed)
+        cv2.imwrite(outdir+'/images/'+prefix+'.png',img)
+
+    # we already have the ellipses & image in memory, so no need for gen_masks etc. to read them back in
+    df, results = pd.DataFrame(caption_to_ellipses(caption, np.float64), columns=['cx', 'cy', 'a', 'b', 'angle', 'rings']) if extras else None, {}
+    if ('crops' in extras) and (not done):   # before the annotation file, since that's what marks the frame as done
+        for name, img_cropped, bb, rings in _gen_crops.make_crops(meta_file, df, img=Image.fromarray(img)):
+            img_cropped.save(outdir+'/crops/'+name)
+    if not done:
+        with open(meta_file, "w") as text_file:
+            text_file.write(caption+'\n')
+    if len(extras) == 0: return
+
+    if 'masks' in extras:
+        st = os.stat(meta_file)
+        stats = _gen_masks.handle_one_file(meta_file, df, [(outdir+'/masks', step, False)], False)[0]
+        # what gen_masks --incremental would record, so it won't remake these masks
+        results['mask_entry'] = {'csv':meta_file, 'mtime':st.st_mtime, 'size':st.st_size, 'md5':_gen_masks.file_md5(meta_file),
+                                 'step':step, 'allone':False, 'stats':stats}
+    if 'bboxes' in extras:
+        results['boxes'] = _gen_bboxes.handle_one_file(meta_file, df)
+    return results
+
+
+def handle_batch(outdir, framenums, done=False, ring_method='analytic', placement='rejection', seed=1, **kwargs):
+    "handle_one_file for each of framenums, with the images made all at once. Returns list of results"
+    if done: return [handle_one_file(outdir, k, done, **kwargs) for k in framenums]
+    imgs, captions = make_fake_batch(framenums, ring_method=ring_method, placement=placement, seed=seed)
+    return [handle_one_file(outdir, k, img=img, caption=caption, **kwargs) for k, img, caption in zip(framenums, imgs, captions)]
+
+
+def _stream_worker(queue, worker, jobs, batch_size, start, n, kwargs):
+    "Makes batches worker, worker+jobs, worker+2*jobs, ... for stream_fakes, and puts them in the queue"
+    b = worker
+    try:
+        while (n is None) or (b*batch_size < n):
+            framenums = range(start+b*batch_size, start+min((b+1)*batch_size, n or np.inf))
+            imgs, captions = make_fake_batch(framenums, **kwargs)
+            # copy, since the batch buffer gets reused & the queue pickles things later, in another thread
+            queue.put((b, imgs.copy(), [caption_to_ellipses(caption) for caption in captions]))   # waits here while the queue is full
+            b += jobs
+    except Exception as e:
+        queue.put((b, None, f"{type(e).__name__}: {e}"))
+
+
+def stream_fakes(
+    batch_size=16,      # number of images per batch
+    n=None,             # total number of images to make. None = go on forever
+    jobs=0,             # number of worker processes. 0 = number of CPU cores
+    prefetch=None,      # max number of batches waiting in the queue. None = 2*jobs
+    seed=1, start=0,    # random seed & first frame number, as in gen_fake
+    quiet=False,        # don't report images/sec
+    report_every=10,    # seconds between images/sec reports
+    ring_method='analytic', placement='rejection',
+    bank_file=None,     # cache file for the real images' spectra, as in get_spectrum_bank
+    ):
+    """Yields (images, ellipses) batches of fake images, made in background processes and never written to disk.
+    images is a (B,H,W) uint8 array, ellipses a list of B (N,6) arrays of cx, cy, a, b, angle, rings.
+    Each image is the same as gen_fake would write for its frame number, but batches come in whatever order they're done"""
+    jobs = jobs if jobs > 0 else mp.cpu_count()
+    get_spectrum_bank(bank_file=bank_file)   # before forking, so workers share it
+    queue = mp.Queue(maxsize=prefetch or 2*jobs)
+    kwargs = dict(ring_method=ring_method, placement=placement, seed=seed)
+    procs = [mp.Process(target=_stream_worker, args=(queue, w, jobs, batch_size, start, n, kwargs), daemon=True) for w in range(jobs)]
+    for p in procs: p.start()
+    n_batches = None if n is None else -(-n // batch_size)
+    n_done, t_start, t_report = 0, time.time(), time.time()
+    try:
+        for _ in (itertools.count() if n_batches is None else range(n_batches)):
+            b, imgs, ellipses = queue.get()
+            if imgs is None: raise RuntimeError(f"stream_fakes: worker failed on batch {b}: {ellipses}")
+            yield imgs, ellipses
+            n_done += len(imgs)
+            if (not quiet) and (time.time() - t_report > report_every):
+                print(f"stream_fakes: {n_done} images, {n_done/(time.time()-t_start):.1f} images/sec", flush=True)
+                t_report = time.time()
+    finally:
+        for p in procs: p.terminate()
+        for p in procs: p.join()
+    if not quiet: print(f"stream_fakes: {n_done} images in {time.time()-t_start:.1f} s, {n_done/(time.time()-t_start):.1f} images/sec")
 
 
 @call_parse
 def gen_fake(
+    resume:Param("Skip frames whose files are already there, e.g. to finish an interrupted run", store_true),
+    stream:Param("Don't write any files, just make the images in memory (via stream_fakes) and report images/sec", store_true),
     n:Param("Number of images to generate", int)=2000,
     outdir:Param("Directory to write to",str)='espiownage-fake',
+    jobs:Param("Number of parallel processes to use. 0 = all CPU cores",int)=0,
+    batch:Param("Number of images each process makes at once",int)=16,
+    rings:Param("How to draw rings: 'analytic' (smooth & fast) or 'ellipses' (one cv2 ellipse per ring, as before)",str)='analytic',
+    placement:Param("How to place antinodes: 'rejection' (retry random spots) or 'grid' (pick from free spots)",str)='rejection',
+    seed:Param("Random seed. Each image depends only on this and its frame number",int)=1,
+    start:Param("Frame number of the first image, e.g. to split a big run across machines",int)=0,
+    extras:Param("Also write any of masks,bboxes,crops (comma-separated) from the same worker, instead of running gen_masks etc. afterward",str)='',
+    step:Param("With extras=masks: step size of ring counts for mask classes, as in gen_masks",float)=1,
+    bank:Param("Keep the real images' low-frequency spectra in this .npy file, to skip remaking them next time. '' = don't",str)='',
     ):
     "Generates fake ESPI-like images"
 
-    random.seed(1)   # for reproducibility
-    np.random.seed(1)
+    if stream:
+        for imgs, ellipses in stream_fakes(n=n, jobs=jobs, seed=seed, start=start, batch_size=batch, ring_method=rings, placement=placement, bank_file=bank or None): pass
+        return
 
     mkdir_if_needed(outdir)
     mkdir_if_needed(outdir+'/images')
     mkdir_if_needed(outdir+'/annotations')
-
-    parallel = True  # want this on, this one's slow
-    if not parallel:
-        for framenum in range(n):
-            handle_one_file(outdir, framenum)
-    else:
-        wrapper = partial(handle_one_file, outdir)
-        pool = mp.Pool(mp.cpu_count())
-        results = pool.map(wrapper, range(n))
-        pool.close()
-        pool.join()
+    get_spectrum_bank(bank_file=bank or None)   # make or load it before the workers start, so they share it
+
+    extras = [x.strip() for x in extras.split(',') if x.strip()]
+    for x in extras: mkdir_if_needed(outdir+'/'+x)
+
+    framenums = range(start, start+n)
+    frames = [(k, False) for k in framenums]
+    if resume:   # the annotation file gets written after the image (& crops), so if it's there, the frame is done
+        done = set(os.listdir(outdir+'/annotations'))
+        frames = [(k, frame_prefix(k)+meta_extension in done) for k in framenums]
+        print(f"gen_fake: resuming, {sum(d for k, d in frames)} of {n} images already done")
+        if not (('masks' in extras) or ('bboxes' in extras)): frames = [(k, d) for k, d in frames if not d]
+    items = []   # batches of consecutive frames that are all done or all not, so results still come in frame order
+    for k, d in frames:
+        if items and (items[-1][1] == d) and (len(items[-1][0]) < batch): items[-1][0].append(k)
+        else: items.append(([k], d))
+
+    # bboxes for all frames get written as they come in, just like gen_bboxes does
+    meta_file_list = [outdir+'/annotations/'+frame_prefix(k)+meta_extension for k in framenums]
+    outs = [emitter(meta_file_list, outdir+'/bboxes', 1, False) for emitter in [_gen_bboxes.LongCSVEmitter, _gen_bboxes.CocoJSONEmitter]] if 'bboxes' in extras else []
+
+    # masks go in gen_masks' manifest too, so that a later gen_masks --incremental (run on outdir+'/annotations/*.csv',
+    # from the directory gen_fake was run in) knows they're up to date
+    mask_dir = outdir+'/masks'
+    manifest = _gen_masks.read_manifest(mask_dir) if 'masks' in extras else {}
+
+    wrapper = partial(handle_batch, outdir, ring_method=rings, placement=placement, seed=seed, extras=extras, step=step)
+    n_errors = 0
+    for i, ok, batch_results in parallel_imap(wrapper, items, jobs=jobs, desc='gen_fake: batches '):
+        mask_names = [meta_to_mask_path(frame_prefix(k)+meta_extension, mask_dir=mask_dir+'/').name for k in items[i][0]]
+        if not ok:
+            n_errors += 1
+            for mask_name in mask_names: manifest.pop(mask_name, None)   # so gen_masks --incremental redoes them
+            continue
+        for mask_name, results in zip(mask_names, batch_results):
+            if 'masks' in extras: manifest[mask_name] = results['mask_entry']
+            for out in outs: out.add(results['boxes'])
+    for out in outs: out.close()
+    if 'masks' in extras:
+        _gen_masks.write_manifest(mask_dir, manifest)
+        mask_names = [meta_to_mask_path(f, mask_dir=mask_dir+'/').name for f in meta_file_list]   # histogram as in gen_masks
+        with open(mask_dir+'/'+_gen_masks.histogram_name, 'w') as f:
+            json.dump(_gen_masks.reduce_stats([manifest[m]['stats'] for m in mask_names if m in manifest]), f, indent=1)
+    if n_errors > 0: sys.exit(1)
     return
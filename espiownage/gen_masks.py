@@ -9,8 +9,9 @@ import cv2
 from PIL import Image
 from espiownage.core import *
 from functools import partial
-import multiprocessing as mp
 import sys
+import json
+import hashlib
 
 """ Note that (normally) we don't care about the actual images. we're just generating
     image masks from the annotations
@@ -18,46 +19,124 @@ import sys
 
 
 imgbank, ann_img_dir = "images/", "annotated_images/"
-all_colors = {0}
-
-def handle_one_file(meta_file_list, # list of all the csv files
-    mask_dir,                # output directory, where to write mask files to
-    step,                   # resolution of (float) rings, when converting to int
+mask_buf = None   # each process re-uses one mask array rather than allocating one per file
+manifest_name = 'gen_masks_manifest.json'  # lives in the mask directory; records what each mask was made from
+histogram_name = 'class_histogram.json'    # also in the mask directory: class frequencies over the whole dataset
+
+
+def file_md5(filename):
+    "Hash of a file's contents"
+    with open(filename, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def read_manifest(mask_dir):
+    "Reads the manifest of mask files -> info about the annotations & settings they were made with"
+    manifest_file = mask_dir+'/'+manifest_name
+    if not os.path.exists(manifest_file): return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def write_manifest(mask_dir, manifest):
+    "Writes the manifest atomically, so an interrupted run can't leave a broken one"
+    manifest_file = mask_dir+'/'+manifest_name
+    with open(manifest_file+'.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_file+'.tmp', manifest_file)
+
+
+def find_stale(meta_file_list, mask_dir, manifest, step, allone):
+    """Indices of annotation files whose masks need (re)making: no mask yet, different step/allone,
+    or CSV changed. A changed mtime alone isn't enough: the file's contents have to differ too"""
+    stale = []
+    for i, meta_file in enumerate(meta_file_list):
+        mask_path = meta_to_mask_path(meta_file, mask_dir=mask_dir+'/')
+        entry, st = manifest.get(mask_path.name, None), os.stat(meta_file)
+        if (entry is None) or (not mask_path.exists()) or (entry['csv'] != meta_file) \
+            or (entry['step'] != step) or (entry['allone'] != allone):
+            stale.append(i)
+        elif (entry['mtime'] != st.st_mtime) or (entry['size'] != st.st_size):
+            if (entry.get('md5') is None) or (entry['md5'] != file_md5(meta_file)): stale.append(i)
+            else: entry['mtime'], entry['size'] = st.st_mtime, st.st_size  # just touched, not changed
+    return stale
+
+
+def remove_orphans(mask_dir, manifest, quiet=False):
+    "Deletes masks (that we made) whose annotation files no longer exist"
+    for mask_name in [m for m, entry in manifest.items() if not os.path.exists(entry['csv'])]:
+        if os.path.exists(mask_dir+'/'+mask_name): os.remove(mask_dir+'/'+mask_name)
+        if not quiet: print(f"gen_masks: removed {mask_name}: {manifest[mask_name]['csv']} is gone")
+        del manifest[mask_name]
+
+def mask_stats(img, colors):
+    "Per-mask statistics: pixel counts of each class present, and how many ellipses of each class were drawn"
+    counts = np.bincount(img.ravel())
+    ell_classes, ell_counts = np.unique(np.array(colors, dtype=int), return_counts=True)
+    return {'pixels': {str(c): int(counts[c]) for c in np.nonzero(counts)[0]},
+            'ellipses': {str(c): int(n) for c, n in zip(ell_classes, ell_counts)}}
+
+
+def reduce_stats(stats_list):
+    "Combines per-mask statistics into a dataset-wide class histogram"
+    pixels, ellipses, files_with = {}, {}, {}
+    for stats in stats_list:
+        for c, n in stats['pixels'].items():
+            pixels[c] = pixels.get(c, 0) + n
+            files_with[c] = files_with.get(c, 0) + 1
+        for c, n in stats['ellipses'].items():
+            ellipses[c] = ellipses.get(c, 0) + n
+    classes = sorted(int(c) for c in pixels.keys())
+    pixels, ellipses, files_with = [{str(c): d[str(c)] for c in classes if str(c) in d} for d in (pixels, ellipses, files_with)]
+    total = sum(pixels.values())
+    return {'num_masks': len(stats_list), 'num_ellipses': sum(ellipses.values()), 'classes': classes,
+            'pixel_counts': pixels, 'pixel_fraction': {c: n/total for c, n in pixels.items()},
+            'ellipse_counts': ellipses, 'masks_with_class': files_with}
+
+
+def parse_variants(maskdir, step, allone, steps):
+    "List of (mask_dir, step, allone) mask sets to make. steps is e.g. '0.7,1,allone', each going to its own directory"
+    if not steps: return [(maskdir.rstrip('/'), step, allone)]
+    variants = []
+    for s in steps.split(','):
+        s = s.strip()
+        if s == 'allone': variants.append((maskdir.rstrip('/')+'_allone', 1.0, True))
+        else:             variants.append((maskdir.rstrip('/')+f'_{float(s):g}', float(s), False))
+    return variants
+
+
+def handle_one_file(meta_file, # the csv file to make a mask for
+    df,                     # ellipse data for this file, e.g. from annotation index. None = read the csv
+    variants,               # list of (mask_dir, step, allone): which masks to make from this file
     #imglinks,               # boolean on whether or not to create links to original images
-    allone,                 # set all values to one for non-background
     cp_ann_imgs,            # hack to make directory of only images for which annotations exist
-    quiet,                   # don't print many status messages
-    i,                      # index of which meta file we'll read from
     height=512, width=384):  # image dimensions
-    global all_colors, ann_img_dir
+    global ann_img_dir, mask_buf
 
-    meta_file = meta_file_list[i]
     col_names = ['cx', 'cy', 'a', 'b', 'angle', 'rings']
-    df = pd.read_csv(meta_file, header=None, names=col_names)
-
-    # progress message
-    mask_path = meta_to_mask_path(meta_file, mask_dir=mask_dir+'/')
-    if not quiet:
-        print(f"{i}/{len(meta_file_list)}: meta_file = {meta_file}, mask_path = {mask_path} ",flush=True)
-
-    df.drop_duplicates(inplace=True)  # sometimes the data from Zooniverse has duplicate rows
-    img = np.zeros((width, height), dtype=np.uint8)  # blank black image, dimensions are wonky
-    for index, row in df.iterrows() :
-        [cx, cy, a, b, angle] = [int(round(x)) for x in [row['cx'], row['cy'], row['a'], row['b'], row['angle']]]
-        rings = round(float(row['rings']),2)
-        a, b, angle = fix_abangle(a,b,angle)
-        if (rings > 0):
-            if rings > 11: # saw an error once
-                print(f"Sever warning for file {meta_file}: rings = {rings}.  Aborting")
-                sys.exit(1)
-            color = 1 if allone else ring_float_to_class_int(rings, step=step)
-            all_colors = all_colors.union({color})
-            img = draw_ellipse(img, (cx,cy), (a,b), angle, color=color, filled=True)
-
-    #all_colors = all_colors.union(set(np.array(img).flatten()))  # super sanity check but slow
-    # cv2.imwrite(str(mask_path), img)  Don't write as cv2, write as PIL
-    pil_image = Image.fromarray(img)
-    pil_image = pil_image.save(str(mask_path))
+    if df is None: df = pd.read_csv(meta_file, header=None, names=col_names)
+
+    if (mask_buf is None) or (mask_buf.shape != (width, height)):
+        mask_buf = np.zeros((width, height), dtype=np.uint8)  # dimensions are wonky
+    img = mask_buf                 # reuse the same image array for every mask this process makes
+    df = normalize_ann_df(df)
+    all_rings = np.array([round(float(r),2) for r in df['rings']])
+    has_rings = all_rings > 0
+    if (all_rings > 11).any(): # saw an error once
+        raise ValueError(f"Severe warning for file {meta_file}: rings = {all_rings.max()}")
+    ellipses = df[col_names[:5]].values[has_rings]   # same geometry for every mask set; only the colors change
+
+    all_stats = []
+    for mask_dir, step, allone in variants:
+        mask_path = meta_to_mask_path(meta_file, mask_dir=mask_dir+'/')
+        img[:] = 0                     # blank black image
+        colors = [1 if allone else ring_float_to_class_int(rings, step=step) for rings in all_rings[has_rings]]
+        draw_ellipses(img, ellipses, colors)
+        all_stats.append(mask_stats(img, colors))
+
+        # cv2.imwrite(str(mask_path), img)  Don't write as cv2, write as PIL
+        pil_image = Image.fromarray(img)
+        pil_image = pil_image.save(str(mask_path))
 
 
     if cp_ann_imgs:
@@ -65,8 +144,13 @@ def handle_one_file(meta_file_list, # list of all the csv files
         dest_img = ann_img_dir+os.path.basename(src_img)
         shutil.copyfile(src_img, dest_img)
 
-    return img
+    return all_stats  # one for each mask set. (don't send the image back to the parent process)
+
 
+def handle_one_file_md5(meta_file, df, variants, cp_ann_imgs):
+    "handle_one_file, plus the md5 of the csv (for the manifest of an incremental run)"
+    md5 = file_md5(meta_file)   # before reading it, like the mtime & size the parent recorded
+    return handle_one_file(meta_file, df, variants, cp_ann_imgs), md5
 
 
 @call_parse
@@ -74,30 +158,60 @@ def gen_masks(
     allone:Param("All objects get assigned to class 1", store_true),
     quiet:Param("Suppress output log", store_true),
     cp_ann_imgs:Param("make directory of only images for which annotations exist (to annotated_images/)", store_true),
+    incremental:Param("Only (re)make masks whose annotations or settings changed; remove masks of deleted annotations", store_true),
     files:Param("Wildcard name for all CSV files to edit", str)='annotations/*.csv',
     maskdir:Param("Directory to write segmentation masks to",str)='masks/',
     step:Param("Step size / resolution / precision of ring count",float)=1,
+    index:Param("Read annotations via this (auto-refreshed) annotation index file, e.g. ann_index.npz",str)='',
+    jobs:Param("Number of parallel processes to use. 0 = all CPU cores",int)=0,
+    steps:Param("Make several mask sets in one pass, e.g. '0.7,1,allone' writes to {maskdir}_0.7/, {maskdir}_1/, {maskdir}_allone/",str)='',
     ):
     "Generate segmentation masks for all annotations"
-    global all_colors, ann_img_dir
+    global ann_img_dir
 
-    mkdir_if_needed(maskdir)
+    variants = parse_variants(maskdir, step, allone, steps)
+    for mask_dir, _, _ in variants: mkdir_if_needed(mask_dir)
     if cp_ann_imgs: mkdir_if_needed(ann_img_dir)
 
     files = ''.join(files)
     meta_file_list = sorted(glob.glob(files))
-
-    parallel = True  # could leave off. it's not that slow, really
-    if not parallel:
-        for i in range(len(meta_file_list)):
-            handle_one_file(meta_file_list, maskdir, step, allone, cp_ann_imgs, quiet, i)
-        print("all_colors = ",sorted(list(all_colors))) # Very handy
+    dfs = split_ann_index(build_ann_index(files, index), meta_file_list) if index else [None]*len(meta_file_list)
+
+    manifests = [read_manifest(mask_dir) for mask_dir, _, _ in variants]
+    if incremental:
+        todo = set()   # a file gets redone for all mask sets if it's stale in any of them
+        for (mask_dir, v_step, v_allone), manifest in zip(variants, manifests):
+            remove_orphans(mask_dir, manifest, quiet=quiet)
+            todo = todo.union(find_stale(meta_file_list, mask_dir, manifest, v_step, v_allone))
+        todo = sorted(todo)
+        print(f"gen_masks: {len(todo)} of {len(meta_file_list)} annotation files need their masks (re)made")
     else:
-        # parallel processing
-        wrapper = partial(handle_one_file, meta_file_list, maskdir, step, allone, cp_ann_imgs, quiet)
-        pool = mp.Pool(mp.cpu_count())
-        results = pool.map(wrapper, range(len(meta_file_list)))
-        pool.close()
-        pool.join()
+        todo = list(range(len(meta_file_list)))
+    file_info = {}   # record what the masks are made from before making them, in case a csv changes while we work
+    for i in todo:
+        st = os.stat(meta_file_list[i])
+        file_info[i] = {'csv':meta_file_list[i], 'mtime':st.st_mtime, 'size':st.st_size, 'md5':None}
+
+    # md5s are only needed by --incremental, and then the workers compute them
+    wrapper = partial(handle_one_file_md5 if incremental else handle_one_file, variants=variants, cp_ann_imgs=cp_ann_imgs)
+    results, errors = parallel_map(wrapper, [(meta_file_list[i], dfs[i]) for i in todo], jobs=jobs, quiet=quiet, desc='gen_masks: ')
+    if incremental:
+        for j, i in enumerate(todo):
+            if results[j] is not None: results[j], file_info[i]['md5'] = results[j]
+    failed = set(todo[j] for j, _ in errors)
+    for v, ((mask_dir, v_step, v_allone), manifest) in enumerate(zip(variants, manifests)):
+        for j, i in enumerate(todo):
+            mask_name = meta_to_mask_path(meta_file_list[i], mask_dir=mask_dir+'/').name
+            if i in failed: manifest.pop(mask_name, None)   # so we try again next time
+            else: manifest[mask_name] = dict(file_info[i], step=v_step, allone=v_allone, stats=results[j][v])
+        write_manifest(mask_dir, manifest)
+
+        # class histogram for the whole dataset, from stats stored in the manifest (so incremental runs get it too)
+        mask_names = [meta_to_mask_path(f, mask_dir=mask_dir+'/').name for f in meta_file_list]
+        histogram = reduce_stats([manifest[m]['stats'] for m in mask_names if (m in manifest) and ('stats' in manifest[m])])
+        with open(mask_dir+'/'+histogram_name, 'w') as f:
+            json.dump(histogram, f, indent=1)
+        print(f"gen_masks: {mask_dir}: classes = {histogram['classes']}") # Very handy
+    if len(errors) > 0: sys.exit(1)
 
     return